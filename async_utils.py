@@ -0,0 +1,242 @@
+"""Asyncio counterpart of scraping_utils.get_response().
+
+Thousands of requests may be in flight on a single thread. The same headers,
+timeouts, retries, per-host connection limits and adaptive rate limiting are
+applied as for blocking requests. The response cache (and OFFLINE mode) and
+the Tor pool are shared with blocking requests as well: each request is
+routed through the next healthy Tor circuit via aiohttp_socks. Only the I/O
+is implemented here: cache lookups and revalidation, Tor circuit selection
+and response status handling are the functions of scraping_utils, they are
+run in the default executor, so they do not stall the event loop.
+
+aiohttp (and aiohttp_socks for proxies) are optional dependencies, they are
+required only when AsyncFetcher is used.
+"""
+import time
+import asyncio
+import logging
+from urllib.parse import urlparse
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    from aiohttp_socks import ProxyConnector, ProxyError
+except ImportError:
+    ProxyConnector = None
+    ProxyError = OSError
+
+import scraping_utils
+from scraping_utils import (HEADERS, TIMEOUT, MAX_RETRIES, HOST_CONNECTIONS,
+                            RATE_LIMITER, lookup_cache, revalidate_response,
+                            get_request_proxy, register_request_error,
+                            check_response, register_request_failure)
+from http_cache import get_conditional_headers
+from metrics import METRICS
+
+# Maximum count of simultaneous connections
+ASYNC_CONCURRENCY = 1000
+
+# Maximum count of simultaneous connections to a single host, the same
+# politeness limit as for blocking requests
+ASYNC_HOST_CONNECTIONS = HOST_CONNECTIONS
+
+# Runs the blocking function (database or Tor control access) in the default
+# executor, so it does not stall the event loop
+async def run_blocking(function, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, function, *args)
+
+# Times DNS lookups and new connections
+def create_trace_config() -> 'aiohttp.TraceConfig':
+    async def on_dns_start(session, context, params):
+        context.dns_start = time.perf_counter()
+
+    async def on_dns_end(session, context, params):
+        METRICS.observe('http_dns_seconds',
+                        time.perf_counter() - context.dns_start)
+
+    async def on_connect_start(session, context, params):
+        context.connect_start = time.perf_counter()
+
+    async def on_connect_end(session, context, params):
+        METRICS.observe('http_connect_seconds',
+                        time.perf_counter() - context.connect_start)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_dns_resolvehost_start.append(on_dns_start)
+    trace_config.on_dns_resolvehost_end.append(on_dns_end)
+    trace_config.on_connection_create_start.append(on_connect_start)
+    trace_config.on_connection_create_end.append(on_connect_end)
+    return trace_config
+
+# aiohttp_socks does not know socks5h scheme, remote DNS resolution is
+# requested with rdns argument instead
+def create_proxy_connector(proxy: str, **kwargs) -> 'ProxyConnector':
+    if proxy.startswith('socks5h://'):
+        proxy = 'socks5://' + proxy[len('socks5h://'):]
+        kwargs['rdns'] = True
+    return ProxyConnector.from_url(proxy, **kwargs)
+
+class AsyncFetcher():
+    """Should be used as an asynchronous context manager:
+
+    async with AsyncFetcher() as fetcher:
+        r = await fetcher.get_response(url)
+
+    A separate aiohttp session is kept for each proxy (Tor instance).
+    """
+    def __init__(self, concurrency: int=ASYNC_CONCURRENCY,
+                 host_connections: int=ASYNC_HOST_CONNECTIONS,
+                 proxy: str=None):
+        if aiohttp == None:
+            raise RuntimeError('aiohttp package is required for asyncio '
+                               'crawling.')
+        if proxy == None and scraping_utils.PROXIES:
+            proxy = scraping_utils.PROXIES['https']
+        if ((proxy != None or scraping_utils.get_tor_pool() != None)
+                and ProxyConnector == None):
+            raise RuntimeError('aiohttp_socks package is required for asyncio '
+                               'crawling via SOCKS proxy.')
+
+        self.concurrency = concurrency
+        self.host_connections = host_connections
+        self.proxy = proxy
+        # Proxy URL (None for direct connections) -> session
+        self.sessions = {}
+        # Host -> semaphore limiting concurrent requests
+        self.host_slots = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions = {}
+
+    def get_session(self, proxy: str) -> 'aiohttp.ClientSession':
+        session = self.sessions.get(proxy)
+        if session == None:
+            if proxy != None:
+                connector = create_proxy_connector(
+                    proxy, limit=self.concurrency,
+                    limit_per_host=self.host_connections)
+            else:
+                connector = aiohttp.TCPConnector(
+                    limit=self.concurrency,
+                    limit_per_host=self.host_connections)
+            session = self.sessions[proxy] = aiohttp.ClientSession(
+                connector=connector, headers=HEADERS,
+                timeout=aiohttp.ClientTimeout(total=TIMEOUT),
+                trace_configs=[create_trace_config()])
+        return session
+
+    # Returns the semaphore which limits concurrent requests to the URL host
+    # over all the sessions
+    def get_host_slot(self, url: str) -> asyncio.Semaphore:
+        host = urlparse(url).hostname
+        if host not in self.host_slots:
+            self.host_slots[host] = asyncio.Semaphore(self.host_connections)
+        return self.host_slots[host]
+
+    async def fetch(self, url: str, params: dict=None,
+                    post: bool=False) -> str:
+        """Returns response text or None on failure."""
+        r = await self.get_response(url, params, post)
+        if r == None:
+            return None
+        return r.text
+
+    async def get_response(self, url: str, params: dict=None,
+                           post: bool=False,
+                           cache: bool=True) -> requests.Response:
+        """Returns requests.Response object with loaded body or None on
+        failure. Caching, retries, backoff, rate limiting and Tor routing are
+        the same as for scraping_utils.get_response(): the response should be
+        stored with scraping_utils.cache_response() once it is validated.
+        """
+        response_cache = scraping_utils.get_cache() if cache else None
+        if response_cache == None:
+            return await self._get_response(url, params, post)
+
+        key, entry, r = await run_blocking(lookup_cache, response_cache, url,
+                                           params, post)
+        if r != None or scraping_utils.OFFLINE:
+            return r
+
+        headers = get_conditional_headers(entry) if entry != None else None
+        r = await self._get_response(url, params, post, headers)
+        return await run_blocking(revalidate_response, response_cache, key,
+                                  entry, r)
+
+    async def _get_response(self, url: str, params: dict=None,
+                            post: bool=False,
+                            headers: dict=None) -> requests.Response:
+        method = 'POST' if post else 'GET'
+        for attempt in range(0, MAX_RETRIES):
+            if attempt > 0:
+                METRICS.inc('http_retries', reason=retry_reason)
+                await asyncio.sleep(delay)
+
+            proxy, available = await run_blocking(get_request_proxy, url)
+            if not available:
+                return None
+            proxy_url = self.proxy
+            if proxy != None:
+                proxy_url = proxy.proxies['https']
+            session = self.get_session(proxy_url)
+
+            start = time.perf_counter()
+            wait = RATE_LIMITER.reserve(url)
+            while wait:
+                await asyncio.sleep(wait)
+                wait = RATE_LIMITER.reserve(url)
+            METRICS.observe('rate_limit_wait_seconds',
+                            time.perf_counter() - start)
+
+            METRICS.inc('http_requests', method=method)
+            try:
+                async with self.get_host_slot(url):
+                    start = time.perf_counter()
+                    if post:
+                        request = session.post(url, data=params,
+                                               headers=headers)
+                    else:
+                        request = session.get(url, params=params,
+                                              headers=headers)
+                    async with request as response:
+                        headers_time = time.perf_counter()
+                        r = requests.Response()
+                        r.status_code = response.status
+                        r.url = str(response.url)
+                        r.headers = CaseInsensitiveDict(response.headers)
+                        r.encoding = get_encoding_from_headers(r.headers)
+                        r._content = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ProxyError,
+                    OSError) as e:
+                logging.warning(f'Request to {url} failed: {e!r}')
+                delay, retry_reason = await run_blocking(
+                    register_request_error, url,
+                    isinstance(e, asyncio.TimeoutError), proxy, attempt)
+                continue
+
+            METRICS.observe('http_ttfb_seconds', headers_time - start,
+                            method=method)
+            METRICS.observe('http_download_seconds',
+                            time.perf_counter() - headers_time, method=method)
+
+            # Tor pool reporting may block
+            result, delay, retry_reason = await run_blocking(
+                check_response, url, r, proxy, attempt, bool(headers))
+            if delay == None:
+                return result
+
+        register_request_failure(url)
+        return None
@@ -0,0 +1,381 @@
+"""Offline benchmark of the scraper.
+
+A local stand-in for zoon.ru serves synthetic listing JSON (the API
+responses get_ajax_html() expects) and item pages with configurable latency
+and error rate. The server runs in a separate process, so it does not affect
+the measured memory usage. The benchmark times the crawl (scrape_items()),
+item page parsing (parse_item()) and CSV/JSON export, then reports items per
+second, p50/p99 latencies and peak RSS.
+
+Each run is appended to a JSON Lines file and compared with the previous one.
+
+How to use:
+    python benchmark.py --items 2000 --latency 0.05 --error-rate 0.01
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+import resource
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+import scraping_utils
+import zoon_scraper
+from scraping_utils import get_session, close_session, RATE_LIMITER
+from async_utils import AsyncFetcher
+from zoon_scraper import (parse_item, scrape_items, save_items_csv,
+                          save_items_json, TEMPLATE_SUBST, ITEMS_PER_PAGE,
+                          PAGE_LIMIT)
+
+BENCHMARK_FILENAME = 'benchmark.jsonl'
+
+# Count of distinct items on the stand-in site
+ITEM_COUNT = 1000
+
+# Count of search filters, items of neighbouring filters overlap
+FILTER_COUNT = 10
+
+# Response delay of the stand-in server (seconds)
+LATENCY = 0.02
+
+# Share of responses failing with HTTP 503
+ERROR_RATE = 0.0
+
+# Approximate size of item page HTML (bytes)
+PAGE_SIZE = 100 * 1024
+
+# Count of item pages parsed in the parsing benchmark
+PARSE_COUNT = 100
+
+PHOTO_COUNT = 8
+
+# Social network name -> link
+SOCIAL_NETS = {
+    'ВКонтакте': 'https://vk.com/',
+    'Instagram': 'https://instagram.com/',
+    'Facebook': 'https://facebook.com/',
+}
+
+ITEM_URL_TEMPLATE = '/msk/entertainment/place_{}/'
+
+FILLER = ('<div class="filler"><span>Отзыв посетителя</span><p>Хорошее '
+          'место для отдыха всей семьёй, рекомендую.</p></div>\n')
+
+def get_item_html(item_id: int, page_size: int=PAGE_SIZE) -> str:
+    rnd = random.Random(item_id)
+    photos = ''.join(
+        '<a class="s-icons-white-dot-opacity" data-original="'
+        f'https://img.zoon.ru/{item_id}/{index}.jpg"></a>'
+        for index in range(rnd.randint(0, PHOTO_COUNT)))
+    metros = ''.join(f'<div class="address-metro">Станция {index}</div>'
+                     for index in range(rnd.randint(0, 3)))
+    social_nets = ''.join(
+        '<a href="https://zoon.ru/redirect/?to='
+        f'{link.replace(":", "%3A").replace("/", "%2F")}{item_id}'
+        f'&amp;hash={index}">{name}</a>'
+        for index, (name, link) in enumerate(SOCIAL_NETS.items())
+        if rnd.random() < 0.5)
+    html = (
+        f'<html><body><h1>Место отдыха {item_id}</h1>\n'
+        f'<address class="iblock">Москва, ул. Тестовая, {item_id}</address>'
+        f'<div>ТЦ {rnd.randint(1, 100)}, {rnd.randint(1, 5)} этаж</div>\n'
+        f'{metros}\n'
+        '<div class="service-phones-list"><span class="js-phone" '
+        f'data-number="+7 495 {item_id:07d}"></span></div>\n'
+        f'{photos}\n'
+        '<dl><dt>Описание</dt><dd>'
+        + '<p>Описание места отдыха.</p>' * rnd.randint(1, 5)
+        + '</dd>\n<dt>Развлечения</dt><dd><a>Батуты</a><a>Квесты</a></dd>\n'
+        '<dt>Время работы</dt><dd><div>пн-пт 10:00-22:00<br/>'
+        '<span>сб-вс 09:00-23:00</span></div></dd>\n'
+        '<dt>Страница в соцсетях</dt>'
+        f'<dd><div>{social_nets}</div></dd></dl>\n')
+    html += FILLER * max(0, (page_size - len(html)) // len(FILLER))
+    return html + '</body></html>'
+
+# Item IDs listed by the filter. Each filter covers its share of items and
+# the same amount of items of the next filters, so the half are duplicates.
+def get_filter_item_ids(filter_index: int, item_count: int,
+                        filter_count: int) -> list:
+    share = max(1, item_count // filter_count)
+    window = min(2 * share, PAGE_LIMIT * ITEMS_PER_PAGE)
+    start = filter_index * share
+    return [(start + index) % item_count for index in range(window)]
+
+def get_listing_html(item_ids: list, page: int, host: str) -> str:
+    page_ids = item_ids[(page - 1) * ITEMS_PER_PAGE:page * ITEMS_PER_PAGE]
+    html = ''.join(
+        '<div class="service-description"><a class="js-item-url" '
+        f'href="http://{host}{ITEM_URL_TEMPLATE.format(item_id)}"></a></div>'
+        for item_id in page_ids)
+    if page * ITEMS_PER_PAGE < len(item_ids):
+        html += '<span>Показать еще</span>'
+    return html
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send(self, status: int, body: str, content_type: str):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Returns True if the request should fail
+    def delay(self) -> bool:
+        time.sleep(self.server.latency)
+        if random.random() < self.server.error_rate:
+            self.send(503, 'Service Unavailable', 'text/plain')
+            return True
+        return False
+
+    def do_GET(self):
+        if self.delay():
+            return
+        try:
+            item_id = int(self.path.rstrip('/').rsplit('_', 1)[1])
+        except (IndexError, ValueError):
+            self.send(404, 'Not Found', 'text/plain')
+            return
+        self.send(200, get_item_html(item_id, self.server.page_size),
+                  'text/html')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        params = parse_qs(self.rfile.read(length).decode('utf-8'))
+        if self.delay():
+            return
+        page = int(params.get('page', ['1'])[0])
+        # Filter names are 'm[<index>]', combined filters use the first one
+        filter_index = min(int(name[2:-1]) for name in params
+                           if name.startswith('m['))
+        item_ids = get_filter_item_ids(filter_index, self.server.item_count,
+                                       self.server.filter_count)
+        html = get_listing_html(item_ids, page, self.headers['Host'])
+        self.send(200, json.dumps({'html': html}), 'application/json')
+
+    def log_message(self, format, *args):
+        pass
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # Clients closing connections on timeout are not errors here
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+def run_server(args: argparse.Namespace, port_queue: multiprocessing.Queue):
+    server = StandInServer(('127.0.0.1', 0), StandInHandler)
+    server.latency = args.latency
+    server.error_rate = args.error_rate
+    server.page_size = args.page_size
+    server.item_count = args.items
+    server.filter_count = args.filters
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+def start_server(args: argparse.Namespace) -> tuple:
+    """Returns (server process, base URL) tuple."""
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_server,
+                                      args=(args, port_queue), daemon=True)
+    process.start()
+    return process, f'http://127.0.0.1:{port_queue.get()}/'
+
+# Nearest-rank percentile
+def get_percentile(values: list, percent: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    index = max(0, min(len(values) - 1,
+                       round(percent / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+# Peak resident set size of the process (MB)
+def get_peak_rss() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return peak / 1024 / 1024
+    return peak / 1024
+
+def get_stats(count: int, elapsed: float, latencies: list=None) -> dict:
+    stats = {
+        'count': count,
+        'seconds': round(elapsed, 3),
+        'items_per_second': round(count / elapsed, 1) if elapsed else 0,
+    }
+    if latencies != None:
+        stats['p50_ms'] = round(get_percentile(latencies, 50) * 1000, 2)
+        stats['p99_ms'] = round(get_percentile(latencies, 99) * 1000, 2)
+    stats['peak_rss_mb'] = round(get_peak_rss(), 1)
+    return stats
+
+# Points the scraper to the stand-in server
+def setup_scraper(base_url: str, args: argparse.Namespace, temp_dir: str):
+    zoon_scraper.BASE_URL_TEMPLATE = base_url.replace(
+        '://', '://' + TEMPLATE_SUBST)
+    zoon_scraper.SUBDOMAINS = {
+        zoon_scraper.DEFAULT_SUBDOMAIN_NAME: zoon_scraper.DEFAULT_SUBDOMAIN}
+    zoon_scraper.USE_ASYNC = args.use_async
+    zoon_scraper.FILTERS_FILENAME = os.path.join(temp_dir, 'filters.html')
+    with open(zoon_scraper.FILTERS_FILENAME, 'w', encoding='utf-8') as f:
+        for index in range(args.filters):
+            f.write(f'<input type="checkbox" name="m[{index}]" value="1">\n')
+
+    scraping_utils.USE_CACHE = False
+    RATE_LIMITER.initial_rate = RATE_LIMITER.max_rate = args.rate
+    RATE_LIMITER.burst = args.rate
+
+# Records the duration of each fetch (including retries)
+class TimedAsyncFetcher(AsyncFetcher):
+    latencies = []
+
+    async def get_response(self, url: str, params: dict=None,
+                           post: bool=False, cache: bool=True):
+        start = time.perf_counter()
+        try:
+            return await super().get_response(url, params, post, cache)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+def benchmark_crawl(args: argparse.Namespace) -> tuple:
+    """Returns (stats, items) tuple. Latencies are measured for each HTTP
+    request, in asyncio mode for each fetch including retries.
+    """
+    if args.use_async:
+        latencies = TimedAsyncFetcher.latencies
+        zoon_scraper.AsyncFetcher = TimedAsyncFetcher
+    else:
+        latencies = []
+        get_session().hooks['response'].append(
+            lambda r, *args, **kwargs: latencies.append(
+                r.elapsed.total_seconds()))
+
+    start = time.perf_counter()
+    items = scrape_items([])
+    elapsed = time.perf_counter() - start
+    close_session()
+
+    stats = get_stats(len(items), elapsed, latencies)
+    stats['requests'] = len(latencies)
+    return stats, items
+
+def benchmark_parse(args: argparse.Namespace) -> dict:
+    pages = [(f'http://127.0.0.1{ITEM_URL_TEMPLATE.format(item_id)}',
+              get_item_html(item_id, args.page_size))
+             for item_id in range(args.parse_count)]
+
+    latencies = []
+    start = time.perf_counter()
+    for url, html in pages:
+        parse_start = time.perf_counter()
+        parse_item(url, html)
+        latencies.append(time.perf_counter() - parse_start)
+    elapsed = time.perf_counter() - start
+
+    return get_stats(len(pages), elapsed, latencies)
+
+def benchmark_export(items: list, temp_dir: str) -> dict:
+    stats = {}
+    filename = os.path.join(temp_dir, 'items.csv')
+    start = time.perf_counter()
+    save_items_csv(items, filename)
+    stats['csv'] = get_stats(len(items), time.perf_counter() - start)
+
+    filename = os.path.join(temp_dir, 'items.json')
+    start = time.perf_counter()
+    save_items_json([item.to_dict() for item in items], filename)
+    stats['json'] = get_stats(len(items), time.perf_counter() - start)
+    return stats
+
+def load_previous(filename: str) -> dict:
+    previous = None
+    try:
+        with open(filename, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    previous = json.loads(line)
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+
+    return previous
+
+def save_results(results: dict, filename: str):
+    try:
+        with open(filename, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(results, ensure_ascii=False) + '\n')
+    except OSError:
+        logging.error(f"Can't write to the file {filename}.")
+
+def print_results(results: dict, previous: dict=None):
+    for stage, stats in results['stages'].items():
+        line = f'{stage:>6}: ' + ', '.join(f'{key} {value}'
+                                           for key, value in stats.items())
+        previous_stats = (previous or {}).get('stages', {}).get(stage)
+        if previous_stats and previous_stats.get('items_per_second'):
+            change = (stats['items_per_second']
+                      / previous_stats['items_per_second'] - 1) * 100
+            line += f' ({change:+.1f}% items/s vs previous run)'
+        print(line)
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--items', type=int, default=ITEM_COUNT)
+    parser.add_argument('--filters', type=int, default=FILTER_COUNT)
+    parser.add_argument('--latency', type=float, default=LATENCY,
+                        help='server response delay (seconds)')
+    parser.add_argument('--error-rate', type=float, default=ERROR_RATE,
+                        help='share of HTTP 503 responses')
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE,
+                        help='item page size (bytes)')
+    parser.add_argument('--parse-count', type=int, default=PARSE_COUNT)
+    parser.add_argument('--rate', type=float, default=1000,
+                        help='request rate limit (requests per second)')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='use the asyncio crawl engine')
+    parser.add_argument('--output', default=BENCHMARK_FILENAME,
+                        help='JSON Lines file with results of all the runs')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    previous = load_previous(args.output)
+
+    process, base_url = start_server(args)
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            setup_scraper(base_url, args, temp_dir)
+            stages = {}
+            stages['parse'] = benchmark_parse(args)
+            stages['crawl'], items = benchmark_crawl(args)
+            export_stats = benchmark_export(items, temp_dir)
+            stages['csv'] = export_stats['csv']
+            stages['json'] = export_stats['json']
+    finally:
+        process.terminate()
+
+    results = {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'config': {key: value for key, value in vars(args).items()
+                   if key != 'output'},
+        'stages': stages,
+    }
+    print_results(results, previous)
+    save_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Classification of request failures and per-host cooldowns.
+
+Failures are counted by kind, so anti-scraping measures show up as metrics.
+Blocking signals put the affected host on a cooldown which grows
+exponentially with consecutive failures and is reset by the first success.
+Only the workers accessing that host wait, the rest of the crawl goes on.
+"""
+import time
+import logging
+import threading
+from urllib.parse import urlparse
+
+# Failure kinds
+CAPTCHA = 'captcha'
+HTTP_ERROR = 'http_error'
+JSON_ERROR = 'json_error'
+TIMEOUT = 'timeout'
+CONNECTION_ERROR = 'connection_error'
+
+# Base cooldown for each failure kind (seconds)
+COOLDOWNS = {
+    CAPTCHA: 300,
+    HTTP_ERROR: 60,
+    JSON_ERROR: 30,
+    TIMEOUT: 10,
+    CONNECTION_ERROR: 10,
+}
+
+# Maximum cooldown (seconds)
+MAX_COOLDOWN = 30 * 60
+
+# Text fragments of CAPTCHA pages (in lower case)
+CAPTCHA_MARKERS = ('captcha', 'капча')
+
+def is_captcha(text: str) -> bool:
+    text = text.lower()
+    return any(marker in text for marker in CAPTCHA_MARKERS)
+
+class BlockDetector():
+    def __init__(self, cooldowns: dict=COOLDOWNS,
+                 max_cooldown: float=MAX_COOLDOWN):
+        self.base_cooldowns = cooldowns
+        self.max_cooldown = max_cooldown
+        # Failure kind -> count
+        self.counters = dict.fromkeys(cooldowns, 0)
+        # HTTP status -> count
+        self.status_counters = {}
+        # Host -> consecutive failures count
+        self.failures = {}
+        # Host -> time until which it is paused
+        self.cooldowns = {}
+        self.lock = threading.Lock()
+
+    def record(self, kind: str, url: str, status: int=None,
+               pause_host: bool=True) -> float:
+        """Registers the failure. If pause_host is True (e.g. the request was
+        not routed through a proxy which can be paused instead), the host is
+        put on a cooldown. Returns the cooldown duration.
+        """
+        host = urlparse(url).hostname
+        with self.lock:
+            self.counters[kind] = self.counters.get(kind, 0) + 1
+            if status != None:
+                self.status_counters[status] = (
+                    self.status_counters.get(status, 0) + 1)
+            if not pause_host:
+                return 0
+
+            self.failures[host] = self.failures.get(host, 0) + 1
+            cooldown = min(self.max_cooldown,
+                           self.base_cooldowns.get(kind, 0)
+                           * 2 ** (self.failures[host] - 1))
+            self.cooldowns[host] = max(self.cooldowns.get(host, 0),
+                                       time.monotonic() + cooldown)
+
+        logging.warning(f'Failure "{kind}" for {host}, the host is paused '
+                        f'for {cooldown:.0f} s.')
+        return cooldown
+
+    def record_success(self, url: str):
+        host = urlparse(url).hostname
+        if self.failures.get(host):
+            with self.lock:
+                self.failures[host] = 0
+
+    def get_cooldown(self, url: str) -> float:
+        """Returns remaining cooldown time for the URL host (seconds)."""
+        host = urlparse(url).hostname
+        with self.lock:
+            return max(0, self.cooldowns.get(host, 0) - time.monotonic())
+
+    def wait_host(self, url: str):
+        cooldown = self.get_cooldown(url)
+        if cooldown:
+            time.sleep(cooldown)
+
+    def get_counters(self) -> dict:
+        with self.lock:
+            counters = dict(self.counters)
+            for status, count in self.status_counters.items():
+                counters[f'http_{status}'] = count
+        return counters
+
+    def log_stats(self):
+        counters = self.get_counters()
+        logging.info('Request failures: ' + ', '.join(
+            f'{kind}: {count}' for kind, count in counters.items()))
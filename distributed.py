@@ -0,0 +1,283 @@
+"""Distributed crawl: a coordinator and any number of workers sharing a work
+queue (see work_queue module).
+
+The coordinator queues the first listing page of every (subdomain, filter)
+pair for each category, then merges scraped items into the category stores
+and exports CSV files when the queue is drained. Workers process listing
+pages (queueing item pages and the next listing page) and item pages
+(saving parsed items as results). Keys of the tasks make the queue a shared
+deduplication index, so no page is scraped twice for a category (a venue
+listed in several categories gets into each of them). Items already in the
+stores are not queued again.
+
+Workers may run on several machines (e.g. each with its own Tor pool) if the
+queue file is on a shared file system. Delete the queue file to start a new
+crawl from scratch.
+
+How to use:
+    python distributed.py coordinator --queue /mnt/shared/work_queue.sqlite
+    python distributed.py worker --queue /mnt/shared/work_queue.sqlite
+"""
+import os
+import time
+import socket
+import logging
+import argparse
+import threading
+from signal import signal, SIGINT
+
+from url_index import normalize_url
+from item_store import ItemStore
+from work_queue import WorkQueue, QUEUE_FILENAME, DONE, FAILED
+from scraping_utils import (setup_logging, get_response, close_session,
+                            close_cache, start_tor_pool, stop_tor_pool,
+                            BLOCK_DETECTOR, FATAL_ERROR_STR, TIMEOUT,
+                            MAX_RETRIES)
+from rate_limiter import MIN_RATE, BACKOFF_MAX
+from tor_proxy import PROXY_WAIT_TIMEOUT
+from zoon_scraper import (Item, get_item_url, get_ajax_html, parse_listing,
+                          parse_item, register_item_page, load_filters,
+                          load_items, load_crawl_plan, get_default_category,
+                          export_csv, export_parquet, sigint_handler,
+                          ITEMS_PER_PAGE, PAGE_LIMIT, CRAWL_PLAN_FILENAME,
+                          EXPORT_PARQUET)
+
+# Task kinds
+LISTING = 'listing'
+ITEM = 'item'
+
+# Item pages are processed first, so the queue does not grow too much
+PRIORITIES = {LISTING: 0, ITEM: 1}
+
+# Number of worker threads in a worker process
+WORKER_THREADS = 4
+
+# Idle worker checks the queue for new tasks with this period (seconds)
+POLL_INTERVAL = 2
+
+# Period of merging results into the stores (seconds)
+MERGE_INTERVAL = 30
+
+# Worst-case processing time of a task (seconds): every attempt may wait for
+# a Tor circuit, for the slowest rate limit shared by the worker threads and
+# for the request timeout, then back off
+TASK_TIME = MAX_RETRIES * (PROXY_WAIT_TIMEOUT + WORKER_THREADS / MIN_RATE
+                           + TIMEOUT + BACKOFF_MAX)
+
+# Tasks are leased with a margin, so a slow worker does not lose its lease
+# and the task is not processed (and its attempt spent) twice
+LEASE_TIME = 2 * TASK_TIME
+
+def get_listing_task(category: str, caption: str, api_link: str,
+                     item_filter: str, page: int) -> tuple:
+    payload = {
+        'category': category,
+        'caption': caption,
+        'api_link': api_link,
+        'filter': item_filter,
+        'page': page,
+    }
+    key = f'{LISTING} {api_link} {item_filter} {page}'
+    return key, LISTING, payload, PRIORITIES[LISTING]
+
+def get_item_task(category: str, caption: str, url: str) -> tuple:
+    payload = {'category': category, 'caption': caption, 'url': url}
+    # A venue listed in several categories is scraped for each of them
+    key = f'{ITEM} {category} {normalize_url(url)}'
+    return key, ITEM, payload, PRIORITIES[ITEM]
+
+def get_categories(plan_filename: str=None) -> list:
+    if plan_filename != None:
+        return load_crawl_plan(plan_filename)
+    return [get_default_category()]
+
+# Queues the first listing pages and reserves keys of the stored items
+def seed_queue(queue: WorkQueue, categories: list, stores: list) -> int:
+    for category, store in zip(categories, stores):
+        known = [get_item_task(category.name, category.caption,
+                               get_item_url(item))
+                 for item in load_items(store, category.json_filename)]
+        queue.add(known, state=DONE)
+
+    tasks = [get_listing_task(category.name, category.caption, api_link,
+                              item_filter, 1)
+             for category in categories
+             for api_link in category.get_api_links()
+             for item_filter in load_filters(category.filters_filename)]
+    count = queue.add(tasks)
+    logging.info(f'{count} listing tasks queued.')
+    return count
+
+# Appends new results to the stores, returns the last merged result id.
+# The keys set holds (category, normalized URL) tuples of the stored items.
+def merge_results(queue: WorkQueue, stores: dict, keys: set,
+                  after_id: int=0) -> int:
+    count = 0
+    for after_id, result in queue.get_results(after_id):
+        store = stores.get(result['category'])
+        key = (result['category'],
+               normalize_url(get_item_url(result['item'])))
+        if store == None or key in keys:
+            continue
+        keys.add(key)
+        store.append(Item.from_dict(result['item']))
+        count += 1
+
+    if count:
+        logging.info(f'{count} items merged.')
+    return after_id
+
+def coordinate(queue: WorkQueue, categories: list) -> bool:
+    stores = {}
+    try:
+        for category in categories:
+            stores[category.name] = ItemStore(category.store_filename,
+                                              item_factory=Item.from_dict,
+                                              key=get_item_url)
+        store_list = [stores[category.name] for category in categories]
+        seed_queue(queue, categories, store_list)
+        keys = {(name, normalize_url(get_item_url(item)))
+                for name, store in stores.items() for item in store}
+
+        last_id = 0
+        while True:
+            finished = queue.is_finished()
+            last_id = merge_results(queue, stores, keys, last_id)
+            logging.info('Tasks: ' + ', '.join(
+                f'{state}: {count}'
+                for state, count in queue.get_counts().items()))
+            if finished:
+                break
+            time.sleep(MERGE_INTERVAL)
+
+        failed = queue.get_counts()[FAILED]
+        if failed:
+            logging.warning(f'{failed} tasks failed.')
+        for category in categories:
+            if not export_csv(stores[category.name], category.csv_filename):
+                return False
+            if EXPORT_PARQUET and not export_parquet(
+                    stores[category.name], category.parquet_filename):
+                return False
+    finally:
+        for store in stores.values():
+            store.close()
+
+    return True
+
+# Returns (result, new tasks) tuple or None on failure
+def process_task(task: dict) -> tuple:
+    payload = task['payload']
+    if task['kind'] == ITEM:
+        response = get_response(payload['url'])
+        if response == None:
+            return None
+        item = parse_item(payload['url'], response.text, payload['caption'])
+        register_item_page(payload['url'], response, item)
+        if item == None:
+            return None
+        return {'category': payload['category'], 'item': item.to_dict()}, []
+
+    html = get_ajax_html(payload['api_link'], payload['filter'],
+                         payload['page'])
+    if html == None:
+        return None
+    item_links, last_page = parse_listing(html)
+    tasks = [get_item_task(payload['category'], payload['caption'], url)
+             for url in item_links]
+    if (len(item_links) == ITEMS_PER_PAGE and not last_page
+            and payload['page'] < PAGE_LIMIT):
+        tasks.append(get_listing_task(
+            payload['category'], payload['caption'], payload['api_link'],
+            payload['filter'], payload['page'] + 1))
+    return None, tasks
+
+def get_task_url(task: dict) -> str:
+    if task['kind'] == ITEM:
+        return task['payload']['url']
+    return task['payload']['api_link']
+
+def work(queue: WorkQueue, worker: str):
+    # The coordinator may not have seeded the queue yet
+    while not any(queue.get_counts().values()):
+        time.sleep(POLL_INTERVAL)
+
+    while True:
+        task = queue.claim(worker)
+        if task == None:
+            if queue.is_finished():
+                return
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        # The task of a cooling host is returned to the queue, so the
+        # cooldown neither runs out its lease nor spends its attempt
+        cooldown = BLOCK_DETECTOR.get_cooldown(get_task_url(task))
+        if cooldown:
+            queue.release(task, worker)
+            logging.info(f'[{worker}] Host of {task["key"]} is cooling down '
+                         f'for {cooldown:.0f} s.')
+            time.sleep(cooldown)
+            continue
+
+        logging.info(f'[{worker}] Processing {task["key"]}')
+        try:
+            outcome = process_task(task)
+        except Exception as e:
+            logging.error(f'[{worker}] Task {task["key"]} failure: {e!r}')
+            outcome = None
+
+        if outcome == None:
+            queue.fail(task, worker)
+        elif not queue.complete(task, worker, *outcome):
+            logging.warning(f'[{worker}] Lease for {task["key"]} lost.')
+
+def run_workers(queue: WorkQueue, threads: int=WORKER_THREADS):
+    name = f'{socket.gethostname()}-{os.getpid()}'
+    workers = [threading.Thread(target=work,
+                                args=(queue, f'{name}-{index}'))
+               for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Distributed zoon.ru crawl.')
+    parser.add_argument('role', choices=('coordinator', 'worker'))
+    parser.add_argument('--queue', default=QUEUE_FILENAME,
+                        help='work queue file shared by all the processes')
+    parser.add_argument('--plan', default=CRAWL_PLAN_FILENAME,
+                        help='crawl plan file (coordinator only)')
+    parser.add_argument('--threads', type=int, default=WORKER_THREADS,
+                        help='worker threads (worker only)')
+    parser.add_argument('--tor', action='store_true',
+                        help='route worker requests through a Tor pool')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    setup_logging()
+    signal(SIGINT, sigint_handler)
+
+    with WorkQueue(args.queue, lease_time=LEASE_TIME) as queue:
+        if args.role == 'coordinator':
+            categories = get_categories(args.plan)
+            if not categories or not coordinate(queue, categories):
+                logging.error(FATAL_ERROR_STR)
+            return
+
+        if args.tor and not start_tor_pool():
+            logging.error(FATAL_ERROR_STR)
+            return
+        try:
+            run_workers(queue, args.threads)
+        finally:
+            close_session()
+            close_cache()
+            stop_tor_pool()
+        logging.info('The queue is drained, the worker is stopped.')
+
+
+if __name__ == '__main__':
+    main()
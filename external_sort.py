@@ -0,0 +1,90 @@
+"""External-memory sorting for item streams.
+
+Items are read in chunks of limited size, each chunk is sorted in memory and
+saved to a temporary JSON Lines file (a sorted run), then the runs are merged
+lazily with heapq.merge(). The sort is stable, i.e. the ordering is the same
+as for list.sort() with the same key.
+"""
+import json
+import heapq
+import shutil
+import logging
+import tempfile
+import os.path
+
+from item_store import item_to_dict
+
+# Maximum count of items kept in memory while sorting
+SORT_CHUNK_SIZE = 50000
+
+class SortedItems():
+    """Sorted view of an item stream. It can be iterated multiple times,
+    temporary files are removed by close() or on exiting the context.
+
+    Items may be dicts or records with to_dict() method, in the latter case
+    item_factory should restore records from dicts read from sorted runs.
+    """
+    def __init__(self, items, key, chunk_size: int=SORT_CHUNK_SIZE,
+                 temp_dir: str=None, item_factory=None):
+        self.key = key
+        self.item_factory = item_factory
+        self.temp_dir = temp_dir
+        self.chunk = []
+        self.runs = []
+        self.run_dir = None
+
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                self._save_run(chunk)
+                chunk = []
+
+        if self.runs:
+            if chunk:
+                self._save_run(chunk)
+        else:
+            # Everything fits in memory, no merging needed
+            chunk.sort(key=key)
+            self.chunk = chunk
+
+    def _save_run(self, chunk: list):
+        if self.run_dir == None:
+            self.run_dir = tempfile.mkdtemp(prefix='items_sort_',
+                                            dir=self.temp_dir)
+        chunk.sort(key=self.key)
+        filename = os.path.join(self.run_dir, f'run_{len(self.runs)}.jsonl')
+        with open(filename, 'w', encoding='utf-8') as f:
+            for item in chunk:
+                f.write(json.dumps(item_to_dict(item), ensure_ascii=False)
+                        + '\n')
+        self.runs.append(filename)
+        logging.info(f'Sorted run {len(self.runs)} saved.')
+
+    def _read_run(self, filename: str):
+        with open(filename, encoding='utf-8') as f:
+            for line in f:
+                item = json.loads(line)
+                if self.item_factory != None:
+                    item = self.item_factory(item)
+                yield item
+
+    def __iter__(self):
+        if not self.runs:
+            return iter(self.chunk)
+
+        return heapq.merge(*[self._read_run(filename)
+                             for filename in self.runs], key=self.key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.run_dir != None:
+            shutil.rmtree(self.run_dir, ignore_errors=True)
+            self.run_dir = None
+        self.runs = []
+        self.chunk = []
@@ -0,0 +1,115 @@
+"""Per-item fetch log for incremental recrawling.
+
+For every item page it keeps a fingerprint of the parsed item, HTTP
+validators (ETag, Last-Modified) and the time of the last check. Stale pages
+are re-fetched with conditional requests, a new item version is saved only
+if its fingerprint changed. Markup changes which do not affect the item data
+(counters, ads, tokens) are not counted as changes.
+"""
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+import requests
+
+FETCH_LOG_FILENAME = 'fetch_log.sqlite'
+
+# Items checked earlier than this time ago are refreshed (seconds)
+RECRAWL_AGE = 24 * 60 * 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS fetches (
+    url TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    fetched REAL NOT NULL,
+    checked REAL NOT NULL
+);
+'''
+
+def get_fingerprint(item: dict) -> str:
+    """Returns hash of the item data insensitive to the order of keys."""
+    data = json.dumps(item, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+class FetchLog():
+    def __init__(self, filename: str=FETCH_LOG_FILENAME):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, url: str) -> sqlite3.Row:
+        with self.lock:
+            return self.db.execute('SELECT * FROM fetches WHERE url = ?',
+                                   (url,)).fetchone()
+
+    def is_stale(self, url: str, max_age: float=RECRAWL_AGE) -> bool:
+        entry = self.get(url)
+        return entry == None or time.time() - entry['checked'] >= max_age
+
+    def get_conditional_headers(self, url: str) -> dict:
+        entry = self.get(url)
+        headers = {}
+        if entry != None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        return headers
+
+    def is_changed(self, url: str, fingerprint: str) -> bool:
+        entry = self.get(url)
+        return entry == None or entry['fingerprint'] != fingerprint
+
+    def record(self, url: str, fingerprint: str, etag: str=None,
+               last_modified: str=None):
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO fetches VALUES (?, ?, ?, ?, ?, ?)',
+                (url, fingerprint, etag, last_modified, now, now))
+            self.db.commit()
+
+    def record_response(self, url: str, r: requests.Response, item: dict):
+        self.record(url, get_fingerprint(item), r.headers.get('ETag'),
+                    r.headers.get('Last-Modified'))
+
+    def seed(self, items) -> int:
+        """Adds (url, item dict) pairs unknown to the log as just checked,
+        without validators. Items scraped before the log was kept are not
+        re-fetched all at once then. Returns the count of added items.
+        """
+        now = time.time()
+        with self.lock:
+            count = self.db.total_changes
+            self.db.executemany(
+                'INSERT OR IGNORE INTO fetches '
+                'VALUES (?, ?, NULL, NULL, ?, ?)',
+                ((url, get_fingerprint(item), now, now)
+                 for url, item in items))
+            self.db.commit()
+            return self.db.total_changes - count
+
+    # The page was checked and has not changed
+    def touch(self, url: str):
+        with self.lock:
+            self.db.execute('UPDATE fetches SET checked = ? WHERE url = ?',
+                            (time.time(), url))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
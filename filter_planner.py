@@ -0,0 +1,117 @@
+"""Planning of filter walks by their historical yield.
+
+Most filters return items already found under other filters. For each
+(API link, filter) pair the planner keeps the count of walks, listing pages
+requested and new items found. Filters which have not yielded anything new
+for several walks in a row are skipped until the recheck age passes, the
+rest are walked in the order of decreasing yield per page, so the most
+productive filters come first. Unknown filters are always walked first.
+
+A recheck walk starts counting empty walks anew, so a rechecked filter is
+walked on the following runs as well before it may be skipped again.
+"""
+import time
+import sqlite3
+import threading
+
+PLANNER_FILENAME = 'filter_stats.sqlite'
+
+# Filters without new items for this count of walks in a row are skipped
+SKIP_AFTER_WALKS = 2
+
+# Skipped filters are walked again after this time (seconds)
+RECHECK_AGE = 7 * 24 * 60 * 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS filters (
+    api_link TEXT NOT NULL,
+    item_filter TEXT NOT NULL,
+    walks INTEGER NOT NULL,
+    pages INTEGER NOT NULL,
+    new_items INTEGER NOT NULL,
+    empty_walks INTEGER NOT NULL,
+    saturated INTEGER NOT NULL,
+    walked REAL NOT NULL,
+    PRIMARY KEY (api_link, item_filter)
+);
+'''
+
+class FilterPlanner():
+    def __init__(self, filename: str=PLANNER_FILENAME,
+                 skip_after_walks: int=SKIP_AFTER_WALKS,
+                 recheck_age: float=RECHECK_AGE):
+        self.filename = filename
+        self.skip_after_walks = skip_after_walks
+        self.recheck_age = recheck_age
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, api_link: str, item_filter: str) -> sqlite3.Row:
+        with self.lock:
+            return self.db.execute(
+                'SELECT * FROM filters WHERE api_link = ? AND item_filter = ?',
+                (api_link, item_filter)).fetchone()
+
+    def is_skipped(self, api_link: str, item_filter: str) -> bool:
+        entry = self.get(api_link, item_filter)
+        return (entry != None
+                and entry['empty_walks'] >= self.skip_after_walks
+                and time.time() - entry['walked'] < self.recheck_age)
+
+    # New items per listing page, unknown filters go first
+    def get_yield(self, api_link: str, item_filter: str) -> float:
+        entry = self.get(api_link, item_filter)
+        if entry == None or entry['pages'] == 0:
+            return float('inf')
+        return entry['new_items'] / entry['pages']
+
+    def plan(self, api_link: str, item_filters: list) -> list:
+        """Returns filters to walk for the API link, the most productive
+        first. Filters yielding nothing new lately are left out.
+        """
+        planned = [item_filter for item_filter in item_filters
+                   if not self.is_skipped(api_link, item_filter)]
+        planned.sort(key=lambda item_filter: self.get_yield(api_link,
+                                                            item_filter),
+                     reverse=True)
+        return planned
+
+    def record(self, api_link: str, item_filter: str, pages: int,
+               new_count: int, saturated: bool=False):
+        """Registers a filter walk. Saturated filters hit the API page limit,
+        so some of their items could not be listed.
+        """
+        with self.lock:
+            entry = self.db.execute(
+                'SELECT * FROM filters WHERE api_link = ? AND item_filter = ?',
+                (api_link, item_filter)).fetchone()
+            walks = total_pages = new_items = empty_walks = 0
+            if entry != None:
+                walks = entry['walks']
+                total_pages = entry['pages']
+                new_items = entry['new_items']
+                empty_walks = entry['empty_walks']
+            # The walk of a skipped filter is a recheck
+            if empty_walks >= self.skip_after_walks:
+                empty_walks = 0
+            empty_walks = 0 if new_count else empty_walks + 1
+            self.db.execute(
+                'INSERT OR REPLACE INTO filters '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (api_link, item_filter, walks + 1, total_pages + pages,
+                 new_items + new_count, empty_walks, int(saturated),
+                 time.time()))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
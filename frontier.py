@@ -0,0 +1,120 @@
+"""Persistent crawl frontier.
+
+Records completed (API link, filter, page) tuples with the count of new
+items found on each page, filters walked up to the last page and item URLs
+found on listing pages but not scraped yet. All the changes are committed
+immediately, so an interrupted crawl resumes exactly where it stopped.
+"""
+import sqlite3
+import threading
+
+FRONTIER_FILENAME = 'frontier.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pages (
+    api_link TEXT NOT NULL,
+    item_filter TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    new_items INTEGER NOT NULL DEFAULT 0,
+    last INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (api_link, item_filter, page)
+);
+CREATE TABLE IF NOT EXISTS filters (
+    api_link TEXT NOT NULL,
+    item_filter TEXT NOT NULL,
+    PRIMARY KEY (api_link, item_filter)
+);
+CREATE TABLE IF NOT EXISTS pending (
+    url TEXT PRIMARY KEY
+);
+'''
+
+class CrawlFrontier():
+    def __init__(self, filename: str=FRONTIER_FILENAME):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        self._migrate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Adds page statistics columns to files created without them
+    def _migrate(self):
+        columns = [row[1] for row in
+                   self.db.execute('PRAGMA table_info(pages)').fetchall()]
+        for column in ('new_items', 'last'):
+            if column not in columns:
+                self.db.execute(f'ALTER TABLE pages ADD COLUMN {column} '
+                                'INTEGER NOT NULL DEFAULT 0')
+        self.db.commit()
+
+    def _execute(self, query: str, params: tuple=()) -> list:
+        with self.lock:
+            rows = self.db.execute(query, params).fetchall()
+            self.db.commit()
+        return rows
+
+    def is_filter_done(self, api_link: str, item_filter: str) -> bool:
+        return bool(self._execute(
+            'SELECT 1 FROM filters WHERE api_link = ? AND item_filter = ?',
+            (api_link, item_filter)))
+
+    # Returns the first page which has not been completed yet
+    def get_next_page(self, api_link: str, item_filter: str) -> int:
+        rows = self._execute(
+            'SELECT MAX(page) FROM pages WHERE api_link = ? AND item_filter = ?',
+            (api_link, item_filter))
+        return (rows[0][0] or 0) + 1
+
+    def get_progress(self, api_link: str, item_filter: str) -> tuple:
+        """Returns (completed pages count, new items count, last page flag)
+        tuple for the filter walk.
+        """
+        rows = self._execute(
+            'SELECT COUNT(*), COALESCE(SUM(new_items), 0), '
+            'COALESCE(MAX(last), 0) FROM pages '
+            'WHERE api_link = ? AND item_filter = ?',
+            (api_link, item_filter))
+        return rows[0][0], rows[0][1], bool(rows[0][2])
+
+    # The last page is the final page of the filter listing
+    def mark_page_done(self, api_link: str, item_filter: str, page: int,
+                       new_count: int=0, last: bool=False):
+        self._execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)',
+                      (api_link, item_filter, page, new_count, int(last)))
+
+    def mark_filter_done(self, api_link: str, item_filter: str):
+        self._execute('INSERT OR IGNORE INTO filters VALUES (?, ?)',
+                      (api_link, item_filter))
+
+    def get_pending(self) -> list:
+        return [row[0] for row in self._execute('SELECT url FROM pending')]
+
+    def add_pending(self, urls: list):
+        with self.lock:
+            self.db.executemany('INSERT OR IGNORE INTO pending VALUES (?)',
+                                [(url,) for url in urls])
+            self.db.commit()
+
+    def remove_pending(self, urls: list):
+        with self.lock:
+            self.db.executemany('DELETE FROM pending WHERE url = ?',
+                                [(url,) for url in urls])
+            self.db.commit()
+
+    # Forgets all the progress, so the next crawl starts from scratch
+    def reset(self):
+        with self.lock:
+            self.db.executescript('DELETE FROM pages; DELETE FROM filters; '
+                                  'DELETE FROM pending;')
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,158 @@
+"""Persistent on-disk cache for HTTP responses.
+
+Responses are stored in a SQLite database with zlib-compressed bodies. The
+entries are keyed by method, URL and request parameters, expire after a TTL
+and keep ETag/Last-Modified validators for conditional revalidation. The least
+recently used entries are evicted when the cache grows beyond its size limit.
+"""
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import logging
+import threading
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+CACHE_FILENAME = 'http_cache.sqlite'
+
+# Time to live for cached responses (seconds)
+CACHE_TTL = 7 * 24 * 60 * 60
+
+# Maximum total size of compressed bodies (bytes)
+CACHE_MAX_SIZE = 1024 * 1024 * 1024
+
+# Eviction check is performed once per this count of stored responses
+EVICT_INTERVAL = 100
+
+ZLIB_LEVEL = 6
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    headers TEXT NOT NULL,
+    body BLOB NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    stored REAL NOT NULL,
+    accessed REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+'''
+
+class ResponseCache():
+    def __init__(self, filename: str=CACHE_FILENAME, ttl: float=CACHE_TTL,
+                 max_size: int=CACHE_MAX_SIZE):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_size = max_size
+        self.puts = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+
+    @staticmethod
+    def make_key(method: str, url: str, params: dict=None) -> str:
+        params = sorted((str(key), str(value))
+                        for key, value in (params or {}).items())
+        key = json.dumps([method.upper(), url, params], ensure_ascii=False)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> sqlite3.Row:
+        with self.lock:
+            entry = self.db.execute('SELECT * FROM responses WHERE key = ?',
+                                    (key,)).fetchone()
+            if entry != None:
+                self.db.execute('UPDATE responses SET accessed = ? '
+                                'WHERE key = ?', (time.time(), key))
+                self.db.commit()
+        return entry
+
+    def is_fresh(self, entry: sqlite3.Row) -> bool:
+        return time.time() - entry['stored'] < self.ttl
+
+    def put(self, key: str, r: requests.Response):
+        body = zlib.compress(r.content, ZLIB_LEVEL)
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO responses VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, r.url, r.status_code,
+                 json.dumps(dict(r.headers), ensure_ascii=False), body,
+                 r.headers.get('ETag'), r.headers.get('Last-Modified'),
+                 now, now, len(body)))
+            self.db.commit()
+            self.puts += 1
+            if self.puts % EVICT_INTERVAL == 0:
+                self._evict()
+
+    def delete(self, key: str):
+        with self.lock:
+            self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.db.commit()
+
+    # Marks the entry as fresh after successful revalidation (HTTP 304)
+    def touch(self, key: str):
+        now = time.time()
+        with self.lock:
+            self.db.execute('UPDATE responses SET stored = ?, accessed = ? '
+                            'WHERE key = ?', (now, now, key))
+            self.db.commit()
+
+    def evict(self):
+        with self.lock:
+            self._evict()
+
+    def _evict(self):
+        total = self.db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        evicted = 0
+        cursor = self.db.execute(
+            'SELECT key, size FROM responses ORDER BY accessed')
+        keys = []
+        for key, size in cursor:
+            if total <= self.max_size:
+                break
+            keys.append((key,))
+            total -= size
+            evicted += 1
+        self.db.executemany('DELETE FROM responses WHERE key = ?', keys)
+        self.db.commit()
+        logging.info(f'{evicted} responses evicted from the cache.')
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def get_conditional_headers(entry: sqlite3.Row) -> dict:
+    headers = {}
+    if entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry['last_modified']:
+        headers['If-Modified-Since'] = entry['last_modified']
+
+    return headers
+
+# Builds requests.Response object from the cache entry
+def build_response(entry: sqlite3.Row) -> requests.Response:
+    r = requests.Response()
+    r.status_code = entry['status']
+    r.url = entry['url']
+    r.headers = CaseInsensitiveDict(json.loads(entry['headers']))
+    r.encoding = get_encoding_from_headers(r.headers)
+    r._content = zlib.decompress(entry['body'])
+    r.from_cache = True
+
+    return r
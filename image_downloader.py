@@ -0,0 +1,150 @@
+"""Bulk image downloading with content-hash deduplication.
+
+Images are downloaded by a pool of worker threads and streamed to the disk in
+chunks. Each file is named by SHA-256 hash of its content, so identical
+images (e.g. stock photos shared by many places) are stored once. The
+manifest file maps image URLs to file names, already downloaded URLs are
+skipped on resume.
+"""
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+import posixpath
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+from scraping_utils import get_response, fix_filename, IMAGE_CHUNK_SIZE
+
+IMAGES_FOLDER = 'images'
+
+# File name of the manifest inside the images folder (JSON Lines)
+MANIFEST_FILENAME = 'manifest.jsonl'
+
+IMAGE_WORKERS = 8
+
+DEFAULT_EXTENSION = '.jpg'
+
+CONTENT_TYPE_EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+}
+
+def get_extension(url: str, content_type: str=None) -> str:
+    extension = posixpath.splitext(urlparse(url).path)[1].lower()
+    if 1 < len(extension) <= 5:
+        return fix_filename(extension)
+
+    if content_type:
+        content_type = content_type.split(';')[0].strip().lower()
+        return CONTENT_TYPE_EXTENSIONS.get(content_type, DEFAULT_EXTENSION)
+
+    return DEFAULT_EXTENSION
+
+class ImageDownloader():
+    def __init__(self, folder: str=IMAGES_FOLDER,
+                 workers: int=IMAGE_WORKERS):
+        self.folder = folder
+        self.workers = workers
+        self.manifest_path = os.path.join(folder, MANIFEST_FILENAME)
+        # URL -> file name
+        self.files = {}
+        # Content hash -> file name
+        self.hashes = {}
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self._load_manifest()
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.files[record['url']] = record['file']
+                    self.hashes[record['sha256']] = record['file']
+        except FileNotFoundError:
+            pass
+        except OSError:
+            logging.warning(f"Can't load the file {self.manifest_path}.")
+
+    def _save_record(self, url: str, filename: str, digest: str):
+        line = json.dumps({'url': url, 'file': filename, 'sha256': digest},
+                          ensure_ascii=False)
+        with self.lock:
+            self.files[url] = filename
+            self.hashes.setdefault(digest, filename)
+            try:
+                with open(self.manifest_path, 'a', encoding='utf-8') as f:
+                    f.write(line + '\n')
+            except OSError:
+                logging.error(f"Can't write to the file {self.manifest_path}.")
+
+    def is_downloaded(self, url: str) -> bool:
+        filename = self.files.get(url)
+        return (filename != None
+                and os.path.exists(os.path.join(self.folder, filename)))
+
+    def download(self, url: str) -> str:
+        """Returns the image file name (relative to the images folder) or
+        None on failure.
+        """
+        if self.is_downloaded(url):
+            return self.files[url]
+
+        r = get_response(url, stream=True)
+        if r == None:
+            return None
+
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=self.folder, suffix='.part')
+        try:
+            with r, os.fdopen(fd, 'wb') as f:
+                for chunk in r.iter_content(IMAGE_CHUNK_SIZE):
+                    digest.update(chunk)
+                    f.write(chunk)
+        except Exception as e:
+            logging.error(f'Failure while retrieving an image from {url}: '
+                          + str(e))
+            os.remove(temp_path)
+            return None
+
+        digest = digest.hexdigest()
+        filename = fix_filename(
+            digest + get_extension(url, r.headers.get('Content-Type')))
+        with self.lock:
+            filename = self.hashes.get(digest, filename)
+            path = os.path.join(self.folder, filename)
+            try:
+                if os.path.exists(path):
+                    # Duplicate content
+                    os.remove(temp_path)
+                else:
+                    os.replace(temp_path, path)
+            except OSError:
+                logging.error('Can\'t save an image to the disk.')
+                return None
+            self.hashes.setdefault(digest, filename)
+
+        self._save_record(url, filename, digest)
+        return filename
+
+    def download_all(self, urls) -> dict:
+        """Downloads images concurrently. Returns URL -> file name dict for
+        successfully downloaded images.
+        """
+        urls = list(dict.fromkeys(urls))
+        pending = [url for url in urls if not self.is_downloaded(url)]
+        logging.info(f'{len(urls) - len(pending)} images already downloaded, '
+                     f'{len(pending)} to go.')
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(self.download, pending))
+
+        return {url: self.files[url] for url in urls if url in self.files}
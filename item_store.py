@@ -0,0 +1,150 @@
+"""Append-only item store in JSON Lines format.
+
+Every item is written as a single line as soon as it is scraped, so the cost
+of a checkpoint does not depend on the count of items already stored. A line
+is appended with a single write call and flushed to the disk, a partially
+written last line (e.g. after a crash) is ignored on loading and cut off
+before the next append.
+"""
+import os
+import json
+import logging
+import threading
+
+from metrics import METRICS
+
+STORE_FILENAME = 'items.jsonl'
+
+# Size of the chunks read backwards while looking for the end of the last
+# complete line
+TAIL_CHUNK_SIZE = 64 * 1024
+
+# Returns a JSON serialisable dict for items which are not dicts themselves
+def item_to_dict(item) -> dict:
+    return item.to_dict() if hasattr(item, 'to_dict') else item
+
+class ItemStore():
+    """Items may be dicts or records with to_dict() method. If item_factory
+    is given, it is applied to each loaded dict.
+
+    If key function is given, an item may be updated by appending its new
+    version: only the last stored version for each key is loaded.
+    """
+    def __init__(self, filename: str=STORE_FILENAME, fsync: bool=True,
+                 item_factory=None, key=None):
+        self.filename = filename
+        self.fsync = fsync
+        self.item_factory = item_factory
+        self.key = key
+        self.file = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        """Iterates over stored items without loading them all into memory."""
+        if self.key == None:
+            for line_number, item in self._read():
+                yield self._make_item(item)
+            return
+
+        # The first pass finds the last version of each item
+        last_lines = {}
+        for line_number, item in self._read():
+            last_lines[self.key(item)] = line_number
+        last_lines = set(last_lines.values())
+
+        for line_number, item in self._read():
+            if line_number in last_lines:
+                yield self._make_item(item)
+
+    def _make_item(self, item: dict):
+        if self.item_factory != None:
+            return self.item_factory(item)
+        return item
+
+    # Yields (line number, dict) tuples for all the valid lines
+    def _read(self):
+        try:
+            f = open(self.filename, 'rb')
+        except FileNotFoundError:
+            return
+        except OSError:
+            logging.warning(f"Can't load the file {self.filename}.")
+            return
+
+        with f:
+            for line_number, line in enumerate(f, 1):
+                if not line.endswith(b'\n'):
+                    logging.warning(f'Incomplete last line in {self.filename} '
+                                    'ignored.')
+                    break
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    logging.warning(f'Corrupted line {line_number} in '
+                                    f'{self.filename} ignored.')
+                    continue
+                yield line_number, item
+
+    def load(self) -> list:
+        return list(self)
+
+    # Returns the size of the file without its incomplete last line, the
+    # file is scanned backwards, so the last line may be of any length
+    @staticmethod
+    def _get_complete_size(f) -> int:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - TAIL_CHUNK_SIZE)
+            f.seek(start)
+            position = f.read(end - start).rfind(b'\n')
+            if position != -1:
+                return start + position + 1
+            end = start
+        return 0
+
+    def _open(self):
+        # Cutting off incomplete last line left after a crash
+        try:
+            with open(self.filename, 'rb+') as f:
+                size = self._get_complete_size(f)
+                if size != f.seek(0, os.SEEK_END):
+                    logging.warning(f'Incomplete last line in {self.filename} '
+                                    'cut off.')
+                    f.truncate(size)
+        except FileNotFoundError:
+            pass
+
+        self.file = open(self.filename, 'ab')
+
+    def append(self, item: dict) -> bool:
+        return self.extend([item])
+
+    def extend(self, items: list) -> bool:
+        data = b''.join(json.dumps(item_to_dict(item),
+                                   ensure_ascii=False).encode('utf-8')
+                        + b'\n' for item in items)
+        with self.lock, METRICS.timer('store_write_seconds'):
+            try:
+                if self.file == None:
+                    self._open()
+                self.file.write(data)
+                self.file.flush()
+                if self.fsync:
+                    os.fsync(self.file.fileno())
+            except OSError:
+                logging.error(f"Can't write to the file {self.filename}.")
+                return False
+
+        return True
+
+    def close(self):
+        with self.lock:
+            if self.file != None:
+                self.file.close()
+                self.file = None
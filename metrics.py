@@ -0,0 +1,285 @@
+"""Crawler metrics: counters and stage timings.
+
+Hot paths count events (requests, retries, status codes, duplicates) and
+time stages (request phases, parsing, writing) with the global METRICS
+object. Values may have labels, e.g. METRICS.inc('http_responses',
+status=200). Collectors registered with add_collector() supply current
+values of external counters (e.g. block detector failures) at export time.
+
+MetricsReporter periodically logs a summary and writes all the metrics to a
+file in Prometheus text format (or JSON if the file name ends with .json).
+Metrics recorded in process pool workers are lost, so functions run there
+are wrapped with call_timed() and their durations are observed by the
+parent process with observe_timed().
+"""
+import os
+import json
+import time
+import logging
+import functools
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+METRICS_FILENAME = 'metrics.prom'
+
+# Period of summary logging and metrics file updates (seconds)
+METRICS_INTERVAL = 60
+
+# Prefix of metric names in Prometheus format
+METRICS_PREFIX = 'zoon_'
+
+# Upper bounds of histogram buckets (seconds)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def call_timed(function, *args) -> tuple:
+    """Returns (result, seconds) tuple for the function call."""
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+class Timing():
+    __slots__ = ('count', 'sum', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        # The last bucket is +Inf
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def merge(self, other: 'Timing'):
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+        for index, count in enumerate(other.buckets):
+            self.buckets[index] += count
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+
+    # Approximate quantile: upper bound of the bucket containing it
+    def get_quantile(self, quantile: float) -> float:
+        rank = quantile * self.count
+        total = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            total += count
+            if total >= rank:
+                return bound
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'max': round(self.max, 6),
+            'p50': self.get_quantile(0.5),
+            'p99': self.get_quantile(0.99),
+        }
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+class Metrics():
+    def __init__(self):
+        # (name, labels) -> value
+        self.counters = {}
+        # (name, labels) -> Timing
+        self.timings = {}
+        self.collectors = []
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, value: float=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            timing = self.timings.get(key)
+            if timing == None:
+                timing = self.timings[key] = Timing()
+            timing.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name: str, **labels):
+        """Decorator timing each call of the function."""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return function(*args, **kwargs)
+            # The metric is known to observe_timed()
+            wrapper.timing = (name, labels)
+            return wrapper
+        return decorator
+
+    def observe_timed(self, function, seconds: float):
+        """Observes the duration of the timed() function call made in
+        another process.
+        """
+        name, labels = function.timing
+        self.observe(name, seconds, **labels)
+
+    def add_collector(self, collector):
+        """collector() should return a list of (name, labels dict, value)
+        tuples for the current values of external counters.
+        """
+        self.collectors.append(collector)
+
+    def get_counters(self) -> dict:
+        with self.lock:
+            counters = dict(self.counters)
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                counters[(name, tuple(sorted(labels.items())))] = value
+        return counters
+
+    def get_timings(self) -> dict:
+        with self.lock:
+            return {key: timing.to_dict()
+                    for key, timing in self.timings.items()}
+
+    def to_json(self) -> str:
+        return json.dumps({
+            'uptime': round(time.monotonic() - self.started, 3),
+            'counters': [{'name': name, 'labels': dict(labels),
+                          'value': value}
+                         for (name, labels), value in
+                         sorted(self.get_counters().items())],
+            'timings': [dict(name=name, labels=dict(labels), **timing)
+                        for (name, labels), timing in
+                        sorted(self.get_timings().items())],
+        }, ensure_ascii=False, indent=4)
+
+    def to_prometheus(self) -> str:
+        lines = []
+        last_name = None
+        for (name, labels), value in sorted(self.get_counters().items()):
+            name = METRICS_PREFIX + name + '_total'
+            if name != last_name:
+                lines.append(f'# TYPE {name} counter')
+                last_name = name
+            lines.append(f'{name}{format_labels(labels)} {value}')
+
+        with self.lock:
+            timings = sorted(self.timings.items())
+            for (name, labels), timing in timings:
+                name = METRICS_PREFIX + name
+                if name != last_name:
+                    lines.append(f'# TYPE {name} histogram')
+                    last_name = name
+                total = 0
+                for bound, count in zip(BUCKETS + ('+Inf',),
+                                        timing.buckets):
+                    total += count
+                    lines.append(
+                        f'{name}_bucket'
+                        f'{format_labels(labels + (("le", bound),))} {total}')
+                lines.append(f'{name}_sum{format_labels(labels)} '
+                             f'{timing.sum:.6f}')
+                lines.append(f'{name}_count{format_labels(labels)} '
+                             f'{timing.count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def save(self, filename: str=METRICS_FILENAME) -> bool:
+        """Writes the metrics atomically, JSON if the file name ends with
+        .json, Prometheus text format otherwise.
+        """
+        if filename.endswith('.json'):
+            text = self.to_json()
+        else:
+            text = self.to_prometheus()
+        temp_filename = filename + '.tmp'
+        try:
+            with open(temp_filename, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(temp_filename, filename)
+        except OSError:
+            logging.error(f"Can't write to the file {filename}.")
+            return False
+
+        return True
+
+    def log_summary(self):
+        uptime = time.monotonic() - self.started
+        counters = {}
+        for (name, labels), value in self.get_counters().items():
+            counters[name] = counters.get(name, 0) + value
+        logging.info(f'Metrics after {uptime:.0f} s: ' + ', '.join(
+            f'{name}: {value:g}' for name, value in sorted(counters.items())))
+
+        # Timings with different labels are summed up
+        timings = {}
+        with self.lock:
+            for (name, labels), timing in self.timings.items():
+                timings.setdefault(name, Timing()).merge(timing)
+        for name, timing in sorted(timings.items()):
+            logging.info(f'{name}: {timing.count} times, average '
+                         f'{timing.sum / timing.count * 1000:.1f} ms, '
+                         f'p99 <= {timing.get_quantile(0.99) * 1000:g} ms, '
+                         f'max {timing.max * 1000:.1f} ms')
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.timings = {}
+            self.started = time.monotonic()
+
+METRICS = Metrics()
+
+class MetricsReporter():
+    """Logs the summary and saves the metrics file every interval seconds
+    and once more on stop().
+    """
+    def __init__(self, metrics: Metrics=METRICS,
+                 filename: str=METRICS_FILENAME,
+                 interval: float=METRICS_INTERVAL):
+        self.metrics = metrics
+        self.filename = filename
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def report(self):
+        self.metrics.log_summary()
+        if self.filename != None:
+            self.metrics.save(self.filename)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread != None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+            self.report()
@@ -0,0 +1,123 @@
+"""Micro-benchmark of text normalisation: the functions of the normalize
+module against their previous implementations. The results of both are
+checked to be equal before timing.
+
+How to use:
+    python normalize_benchmark.py
+"""
+import re
+import random
+import timeit
+import unicodedata
+
+from normalize import (clean_text, join_clean, build_address, fix_filename,
+                       remove_umlauts, NL, METRO_PREFIX)
+
+# Count of calls for each function in a single measurement
+NUMBER = 2000
+
+# Measurements for each function, the best one is taken
+REPEAT = 5
+
+FORBIDDEN_CHAR_RE = r'[<>:"\/\\\|\?\*]'
+
+WORDS = ('Семейный', 'парк', 'приключений', 'батуты', 'квесты', 'Москва',
+         'ул.', 'Ленина', 'ТЦ', '4Daily', 'этаж', 'café', 'Zürich')
+
+SPACES = (' ', '  ', '\n', ' \n\t ', '\r\n', '\xa0')
+
+def legacy_clean_text(text: str) -> str:
+    return re.sub(r'\s+', ' ', text.strip())
+
+def legacy_build_address(address: str, extension: str=None,
+                         metros: list=()) -> str:
+    result = legacy_clean_text(address)
+    if extension != None:
+        result += NL + legacy_clean_text(extension)
+    if metros:
+        result += NL + METRO_PREFIX
+        for metro in metros:
+            result += legacy_clean_text(metro) + ' '
+        result = result.strip()
+    return result
+
+def new_build_address(address: str, extension: str=None,
+                      metros: list=()) -> str:
+    if extension != None:
+        extension = clean_text(extension)
+    return build_address(clean_text(address), extension,
+                         [clean_text(metro) for metro in metros])
+
+def legacy_join_clean(texts: list, separator: str) -> str:
+    lines = []
+    for text in texts:
+        text = legacy_clean_text(text)
+        if text:
+            lines.append(text)
+    return separator.join(lines)
+
+def legacy_fix_filename(filename: str, subst_char: str='_') -> str:
+    return re.sub(FORBIDDEN_CHAR_RE, subst_char, filename)
+
+def legacy_remove_umlauts(text: str) -> str:
+    return (unicodedata.normalize('NFKD', text)
+            .encode('ASCII', 'ignore')
+            .decode('utf-8'))
+
+# Text with irregular whitespace like the one taken from HTML
+def get_fragment(rnd: random.Random, words: int) -> str:
+    return ''.join(rnd.choice(SPACES) + rnd.choice(WORDS)
+                   for _ in range(words)) + rnd.choice(SPACES)
+
+def get_cases(rnd: random.Random) -> list:
+    """Returns (name, legacy function, new function, arguments list)
+    tuples.
+    """
+    fragments = [get_fragment(rnd, rnd.randint(1, 8)) for _ in range(100)]
+    paragraphs = [[get_fragment(rnd, rnd.randint(10, 60))
+                   for _ in range(rnd.randint(1, 8))] for _ in range(100)]
+    addresses = [(get_fragment(rnd, 5), get_fragment(rnd, 3),
+                  [get_fragment(rnd, 2) for _ in range(rnd.randint(0, 4))])
+                 for _ in range(100)]
+    filenames = [rnd.choice(WORDS) + rnd.choice('<>:"/\\|?*. ') + str(index)
+                 for index in range(100)]
+    ascii_texts = [f'https://img.zoon.ru/{index}.jpg' for index in range(100)]
+    return [
+        ('clean_text', legacy_clean_text, clean_text,
+         [(fragment,) for fragment in fragments]),
+        ('description', legacy_join_clean, join_clean,
+         [(lines, NL) for lines in paragraphs]),
+        ('address', legacy_build_address, new_build_address, addresses),
+        ('fix_filename', legacy_fix_filename, fix_filename,
+         [(filename,) for filename in filenames]),
+        ('remove_umlauts (ASCII)', legacy_remove_umlauts, remove_umlauts,
+         [(text,) for text in ascii_texts]),
+        ('remove_umlauts', legacy_remove_umlauts, remove_umlauts,
+         [(fragment,) for fragment in fragments]),
+    ]
+
+# Returns the best time of a single call (seconds)
+def measure(function, args_list: list) -> float:
+    def run():
+        for args in args_list:
+            function(*args)
+
+    number = max(1, NUMBER // len(args_list))
+    return (min(timeit.repeat(run, number=number, repeat=REPEAT))
+            / (number * len(args_list)))
+
+def main():
+    rnd = random.Random(0)
+    print(f'{"function":<24}{"legacy, us":>12}{"new, us":>12}'
+          f'{"speedup":>10}')
+    for name, legacy, new, args_list in get_cases(rnd):
+        for args in args_list:
+            assert legacy(*args) == new(*args), (name, args)
+        legacy_time = measure(legacy, args_list)
+        new_time = measure(new, args_list)
+        print(f'{name:<24}{legacy_time * 1e6:>12.2f}{new_time * 1e6:>12.2f}'
+              f'{legacy_time / new_time:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Adaptive per-host request rate limiting.
+
+Each host gets its own token bucket. The rate grows additively while the host
+responds normally and drops multiplicatively when it signals overload
+(HTTP 429/5xx, timeouts), i.e. the classic AIMD scheme.
+"""
+import time
+import random
+import threading
+from urllib.parse import urlparse
+
+# Requests per second allowed for a host before any feedback is received
+INITIAL_RATE = 2.0
+
+# Lower and upper bounds for the adaptive rate (requests per second)
+MIN_RATE = 0.2
+MAX_RATE = 10.0
+
+# Rate increment after each successful response
+RATE_INCREASE = 0.1
+
+# Rate multiplier after each overload signal
+RATE_DECREASE = 0.5
+
+# Maximum burst size (tokens which can be accumulated by an idle host)
+BURST = 2
+
+# Base and maximum delays for exponential backoff (seconds)
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+class TokenBucket():
+    def __init__(self, rate: float=INITIAL_RATE, capacity: float=BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def reserve(self) -> float:
+        """Takes a token if it is available and returns 0, otherwise returns
+        the delay after which the next attempt should be made. Never blocks,
+        so it is suitable for asyncio code.
+        """
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Blocks until a token is available and takes it."""
+        delay = self.reserve()
+        while delay:
+            time.sleep(delay)
+            delay = self.reserve()
+
+    def set_rate(self, rate: float):
+        with self.lock:
+            self._refill()
+            self.rate = rate
+
+class HostRateLimiter():
+    def __init__(self, initial_rate: float=INITIAL_RATE,
+                 min_rate: float=MIN_RATE, max_rate: float=MAX_RATE,
+                 increase: float=RATE_INCREASE, decrease: float=RATE_DECREASE,
+                 burst: float=BURST):
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get_bucket(self, url: str) -> TokenBucket:
+        host = urlparse(url).hostname
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.initial_rate,
+                                                 self.burst)
+            return self.buckets[host]
+
+    def get_rate(self, url: str) -> float:
+        return self.get_bucket(url).rate
+
+    def acquire(self, url: str):
+        self.get_bucket(url).acquire()
+
+    def reserve(self, url: str) -> float:
+        return self.get_bucket(url).reserve()
+
+    # Successful response: additive increase
+    def speed_up(self, url: str):
+        bucket = self.get_bucket(url)
+        bucket.set_rate(min(self.max_rate, bucket.rate + self.increase))
+
+    # Overload signal: multiplicative decrease
+    def slow_down(self, url: str):
+        bucket = self.get_bucket(url)
+        bucket.set_rate(max(self.min_rate, bucket.rate * self.decrease))
+
+def backoff_delay(attempt: int, base: float=BACKOFF_BASE,
+                  maximum: float=BACKOFF_MAX) -> float:
+    """Returns exponential backoff delay with "full jitter" for the attempt
+    number starting from 0.
+    """
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
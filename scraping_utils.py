@@ -1,14 +1,24 @@
-import re
 import os
 import os.path
 import time
 import logging
 import logging.handlers
-import unicodedata
+import threading
+from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
-from tor_proxy import TOR_SOCKS_PROXIES
+from tor_proxy import TOR_SOCKS_PROXIES, TorPool
+from rate_limiter import HostRateLimiter, backoff_delay, BACKOFF_MAX
+from block_detector import (BlockDetector, TIMEOUT as TIMEOUT_FAILURE,
+                            CONNECTION_ERROR, HTTP_ERROR)
+from http_cache import ResponseCache, build_response, get_conditional_headers
+from metrics import METRICS
+# Text helpers are kept here for compatibility
+from normalize import fix_filename, remove_umlauts, FORBIDDEN_CHAR_RE
 
 # Directory name for saving log files
 LOG_FOLDER = 'logs'
@@ -31,9 +41,18 @@ TIMEOUT = 5
 # Maximum retries count for executing request if an error occurred
 MAX_RETRIES = 3
 
-# The delay after executing an HTTP request (seconds)
-# SLEEP_TIME = 1
-SLEEP_TIME = 0.5
+# HTTP status codes signalling server overload, such requests are retried
+# with exponential backoff
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Maximum simultaneous requests to a single host (politeness limit)
+HOST_CONNECTIONS = 4
+
+# Number of per-host connection pools kept by the HTTP session
+POOL_CONNECTIONS = 16
+
+# Maximum number of keep-alive connections in a single host pool
+POOL_MAXSIZE = HOST_CONNECTIONS
 
 # HTTP headers for making the scraper more "human-like"
 HEADERS = {
@@ -44,25 +63,54 @@ HEADERS = {
 
 USE_TOR = False
 
+# Storing responses in the on-disk cache (see http_cache module)
+USE_CACHE = False
+
+# Serving requests from the cache only, without accessing the network
+OFFLINE = False
+
 # PROXIES = None
 # PROXIES = TOR_SOCKS_PROXIES
 PROXIES = TOR_SOCKS_PROXIES if USE_TOR else None
 
+# Number of Tor instances started by start_tor_pool(), requests are spread
+# over their circuits instead of PROXIES
+TOR_POOL_SIZE = 4
+
+# HTTP status codes meaning the client IP address is blocked
+BLOCKED_STATUS_CODES = (403, 429)
+
 # Common text for displaying while script is shutting down
 FATAL_ERROR_STR = 'Fatal error. Shutting down.'
 
-# Characters not allowed in filenames
-FORBIDDEN_CHAR_RE = r'[<>:"\/\\\|\?\*]'
-
 ICANHAZIP_URL = 'http://icanhazip.com'
 
-def fix_filename(filename: str, subst_char: str='_') -> str:
-    return re.sub(FORBIDDEN_CHAR_RE, subst_char, filename)
+# Chunk size for streamed downloads (bytes)
+IMAGE_CHUNK_SIZE = 64 * 1024
+
+# Per-host semaphores limiting concurrent requests
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+# Adaptive per-host request rate limiter
+RATE_LIMITER = HostRateLimiter()
 
-def remove_umlauts(text: str) -> str:
-    return (unicodedata.normalize('NFKD', text)
-            .encode('ASCII', 'ignore')
-            .decode('utf-8'))
+# Shared HTTP response cache, created on first use if USE_CACHE is set
+_cache = None
+_cache_lock = threading.Lock()
+
+# Request failures classification and per-host cooldowns
+BLOCK_DETECTOR = BlockDetector()
+METRICS.add_collector(lambda: [
+    ('request_failures', {'kind': kind}, count)
+    for kind, count in BLOCK_DETECTOR.get_counters().items()])
+
+# Pool of Tor instances, see start_tor_pool()
+_tor_pool = None
+
+# Shared HTTP session with connection pooling
+_session = None
+_session_lock = threading.Lock()
 
 # Setting up configuration for logging
 def setup_logging():
@@ -89,38 +137,378 @@ def setup_logging():
         fileHandler.setFormatter(logFormatter)
         rootLogger.addHandler(fileHandler)
 
+# Connections timing the creation of their sockets. Unlike asyncio
+# requests, DNS lookup is not timed separately: http_connect_seconds includes
+# it, and TLS handshake is not included. Connections via SOCKS proxy (Tor)
+# are created by another pool manager and are not timed.
+class TimedHTTPConnection(HTTPConnection):
+    def _new_conn(self):
+        start = time.perf_counter()
+        conn = super()._new_conn()
+        METRICS.observe('http_connect_seconds', time.perf_counter() - start)
+        return conn
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def _new_conn(self):
+        start = time.perf_counter()
+        conn = super()._new_conn()
+        METRICS.observe('http_connect_seconds', time.perf_counter() - start)
+        return conn
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
+
+# Creates HTTP session with keep-alive connection pools for each host
+def create_session(pool_connections: int=POOL_CONNECTIONS,
+                   pool_maxsize: int=POOL_MAXSIZE) -> requests.Session:
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    if PROXIES:
+        session.proxies.update(PROXIES)
+
+    adapter = TimedHTTPAdapter(pool_connections=pool_connections,
+                               pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+# Returns the shared session, keep-alive connections are reused by all callers
+def get_session() -> requests.Session:
+    global _session
+
+    with _session_lock:
+        if _session == None:
+            _session = create_session()
+        return _session
+
+def close_session():
+    global _session
+
+    with _session_lock:
+        if _session != None:
+            _session.close()
+            _session = None
+
+def get_cache() -> ResponseCache:
+    global _cache
+
+    if not (USE_CACHE or OFFLINE):
+        return None
+
+    with _cache_lock:
+        if _cache == None:
+            _cache = ResponseCache()
+        return _cache
+
+def close_cache():
+    global _cache
+
+    with _cache_lock:
+        if _cache != None:
+            _cache.close()
+            _cache = None
+
+def start_tor_pool(size: int=TOR_POOL_SIZE) -> bool:
+    global _tor_pool
+
+    pool = TorPool(size)
+    if not pool.start():
+        pool.stop()
+        logging.error('Can\'t start Tor instances.')
+        return False
+
+    _tor_pool = pool
+    return True
+
+def stop_tor_pool():
+    global _tor_pool
+
+    if _tor_pool != None:
+        _tor_pool.stop()
+        _tor_pool = None
+
+def get_tor_pool() -> TorPool:
+    return _tor_pool
+
+# Returns the semaphore which limits concurrent requests to the URL host
+def get_host_slot(url: str) -> threading.BoundedSemaphore:
+    host = urlparse(url).hostname
+    with _host_slots_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(HOST_CONNECTIONS)
+        return _host_slots[host]
+
+# Returns the delay requested by the server with Retry-After header. The
+# delay is limited with BACKOFF_MAX, so a huge value does not stall the
+# worker.
+def get_retry_after(r: requests.Response) -> float:
+    try:
+        delay = float(r.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+    return min(max(0, delay), BACKOFF_MAX)
+
 # Retrieving HTTP GET response implying TIMEOUT and HEADERS
-def get_response(url: str, params: dict=None, post=False) -> requests.Response:
+def get_response(url: str, params: dict=None, post=False,
+                 cache: bool=True, stream: bool=False,
+                 headers: dict=None) -> requests.Response:
     """Input and output parameters are the same as for requests.get() function.
     Also retries, timeouts, headers and error handling are ensured.
+
+    If USE_CACHE is set and cache parameter is True, fresh responses are
+    served from the on-disk cache and stale ones are revalidated with
+    conditional requests. In OFFLINE mode only cached responses are returned.
+    A response fetched from the network is not stored until the caller has
+    validated it with cache_response(), invalid cached responses (e.g.
+    CAPTCHA pages) should be dropped with uncache_response().
+
+    If stream is True, the response body is not loaded into memory and is
+    not cached, the caller should close the response.
+
+    Additional headers bypass the cache. If conditional headers are given,
+    HTTP 304 response is returned as well.
+
+    The function is thread-safe. At most HOST_CONNECTIONS requests are
+    executed simultaneously for a single host and the request rate is
+    controlled by RATE_LIMITER: it grows while the host responds normally and
+    drops on timeouts and RETRY_STATUS_CODES, which are retried with
+    exponential backoff. BLOCKED_STATUS_CODES pause the host in
+    BLOCK_DETECTOR and are not retried, unless the request is made via Tor:
+    then the circuit is paused and the request is retried via another one.
+    """
+    response_cache = None
+    if cache and not stream and not headers:
+        response_cache = get_cache()
+    if response_cache == None:
+        return _get_response(url, params, post, headers, stream)
+
+    key, entry, r = lookup_cache(response_cache, url, params, post)
+    if r != None or OFFLINE:
+        return r
+
+    headers = get_conditional_headers(entry) if entry != None else None
+    r = _get_response(url, params, post, headers)
+    return revalidate_response(response_cache, key, entry, r)
+
+# The cache steps of get_response() shared with the asyncio engine.
+# Returns (key, entry, response) tuple: the response is not None if it is
+# served from the cache, otherwise the request should be made (unless it is
+# OFFLINE mode) with conditional headers for the stale entry, if any.
+def lookup_cache(response_cache: ResponseCache, url: str, params: dict=None,
+                 post: bool=False) -> tuple:
+    key = response_cache.make_key('POST' if post else 'GET', url, params)
+    entry = response_cache.get(key)
+    if entry != None and (OFFLINE or response_cache.is_fresh(entry)):
+        METRICS.inc('http_cache', result='hit')
+        return key, entry, build_cached_response(entry, key)
+    if OFFLINE:
+        logging.error(f'No cached response for {url} in offline mode.')
+    return key, entry, None
+
+# Returns the cached entry if the server has confirmed it is not modified or
+# the response to be stored with cache_response() after its validation
+def revalidate_response(response_cache: ResponseCache, key: str, entry,
+                        r: requests.Response) -> requests.Response:
+    if r == None:
+        return None
+    if r.status_code == requests.codes.not_modified:
+        METRICS.inc('http_cache', result='revalidated')
+        response_cache.touch(key)
+        return build_cached_response(entry, key)
+
+    METRICS.inc('http_cache', result='miss')
+    r.cache_key = key
+    r.from_cache = False
+    return r
+
+def build_cached_response(entry, key: str) -> requests.Response:
+    r = build_response(entry)
+    r.cache_key = key
+    return r
+
+# Stores the response returned by get_response() after the caller has
+# checked its content
+def cache_response(r: requests.Response):
+    key = getattr(r, 'cache_key', None)
+    response_cache = get_cache()
+    if key == None or response_cache == None or r.from_cache:
+        return
+
+    response_cache.put(key, r)
+
+# Drops the response returned by get_response() from the cache, so invalid
+# content (e.g. CAPTCHA page) is not served again
+def uncache_response(r: requests.Response):
+    key = getattr(r, 'cache_key', None)
+    response_cache = get_cache()
+    if key == None or response_cache == None:
+        return
+
+    response_cache.delete(key)
+
+# Each attempt is routed through the next healthy Tor circuit. Returns
+# (proxy, available) tuple: the proxy is None without the Tor pool, and the
+# request is never made directly if the pool has no circuit for it.
+def get_request_proxy(url: str) -> tuple:
+    tor_pool = _tor_pool
+    if tor_pool == None:
+        return None, True
+
+    proxy = tor_pool.get_proxy()
+    if proxy == None:
+        METRICS.inc('http_failures')
+        logging.error(f'No Tor circuit for accessing {url}.')
+        return None, False
+    return proxy, True
+
+# Registers the failed request (timeout or connection error), returns
+# (retry delay, retry reason) tuple
+def register_request_error(url: str, timeout: bool, proxy,
+                           attempt: int) -> tuple:
+    if timeout:
+        retry_reason = 'timeout'
+        BLOCK_DETECTOR.record(TIMEOUT_FAILURE, url, pause_host=False)
+    else:
+        retry_reason = 'connection_error'
+        BLOCK_DETECTOR.record(CONNECTION_ERROR, url, pause_host=False)
+    RATE_LIMITER.slow_down(url)
+    tor_pool = _tor_pool
+    if proxy != None and tor_pool != None:
+        tor_pool.report_failure(proxy)
+    return backoff_delay(attempt), retry_reason
+
+def check_response(url: str, r: requests.Response, proxy, attempt: int,
+                   conditional: bool=False) -> tuple:
+    """Registers the response status with the block detector, the rate
+    limiter and the Tor pool. Returns (response, retry delay, retry reason)
+    tuple: the request should be retried if the delay is not None, otherwise
+    the response (None on failure) is the result of the request. HTTP 304 is
+    accepted for conditional requests.
     """
+    METRICS.inc('http_responses', status=r.status_code)
+    # The proxy used is known to the callers for block handling
+    r.tor_proxy = proxy
+    tor_pool = _tor_pool
+    if r.status_code in BLOCKED_STATUS_CODES:
+        # The blocked Tor circuit is paused instead of the host
+        BLOCK_DETECTOR.record(HTTP_ERROR, url, r.status_code,
+                              pause_host=proxy == None)
+        if proxy == None:
+            # Retrying the paused host would ignore its cooldown and prolong
+            # it, the callers wait for the cooldown (or requeue the page)
+            RATE_LIMITER.slow_down(url)
+            logging.error(f'Error {r.status_code} while accessing {url}, '
+                          'the host is paused.')
+            return None, None, None
+        if tor_pool != None:
+            tor_pool.report_blocked(proxy)
+    elif r.status_code >= 400:
+        BLOCK_DETECTOR.record(HTTP_ERROR, url, r.status_code,
+                              pause_host=False)
+    elif proxy != None and tor_pool != None:
+        tor_pool.report_success(proxy)
+
+    if r.status_code in RETRY_STATUS_CODES:
+        logging.warning(f'Error {r.status_code} while accessing {url}, '
+                        'backing off.')
+        RATE_LIMITER.slow_down(url)
+        delay = get_retry_after(r) or backoff_delay(attempt)
+        return None, delay, f'http_{r.status_code}'
+
+    if r.status_code == requests.codes.not_modified and conditional:
+        RATE_LIMITER.speed_up(url)
+        return r, None, None
+
+    if r.status_code != requests.codes.ok:
+        logging.error(f'Error {r.status_code} while accessing {url}.')
+        return None, None, None
+
+    RATE_LIMITER.speed_up(url)
+    BLOCK_DETECTOR.record_success(url)
+    return r, None, None
+
+# All the attempts have failed
+def register_request_failure(url: str):
+    METRICS.inc('http_failures')
+    logging.error(f'Can\'t execute HTTP request while accessing {url}.')
+
+def _get_response(url: str, params: dict=None, post=False,
+                  headers: dict=None, stream: bool=False) -> requests.Response:
+    session = get_session()
+    method = 'POST' if post else 'GET'
     for attempt in range(0, MAX_RETRIES):
+        if attempt > 0:
+            METRICS.inc('http_retries', reason=retry_reason)
+            time.sleep(delay)
+
+        proxy, available = get_request_proxy(url)
+        if not available:
+            return None
+        proxies = proxy.proxies if proxy != None else None
+
+        with METRICS.timer('rate_limit_wait_seconds'):
+            RATE_LIMITER.acquire(url)
+        METRICS.inc('http_requests', method=method)
+        start = time.perf_counter()
         try:
-            if post:
-                r = requests.post(url, headers=HEADERS, timeout=TIMEOUT,
-                                  data=params, proxies=PROXIES)
-            else:
-                r = requests.get(url, headers=HEADERS, timeout=TIMEOUT,
-                                 params=params, proxies=PROXIES)
-        except requests.exceptions.RequestException:
-            time.sleep(SLEEP_TIME)
-        else:
-            time.sleep(SLEEP_TIME)
-            if r.status_code != requests.codes.ok:
-                logging.error(f'Error {r.status_code} while accessing {url}.')
-                return None
-            return r
+            # The host slot is held for the request only, not for the
+            # backoff between the attempts
+            with get_host_slot(url):
+                if post:
+                    r = session.post(url, timeout=TIMEOUT, data=params,
+                                     headers=headers, proxies=proxies)
+                else:
+                    r = session.get(url, timeout=TIMEOUT, params=params,
+                                    headers=headers, proxies=proxies,
+                                    stream=stream)
+        except requests.exceptions.RequestException as e:
+            logging.warning(f'Request to {url} failed: {e}')
+            delay, retry_reason = register_request_error(
+                url, isinstance(e, requests.exceptions.Timeout), proxy,
+                attempt)
+            continue
 
-    logging.error(f'Can\'t execute HTTP request while accessing {url}.')
+        # Time to the response headers includes DNS lookup and connecting
+        # (for new connections), the rest is spent on the body download
+        elapsed = time.perf_counter() - start
+        ttfb = r.elapsed.total_seconds()
+        METRICS.observe('http_ttfb_seconds', ttfb, method=method)
+        if not stream:
+            METRICS.observe('http_download_seconds', max(0, elapsed - ttfb),
+                            method=method)
+
+        result, delay, retry_reason = check_response(url, r, proxy, attempt,
+                                                     bool(headers))
+        if result == None:
+            r.close()
+        if delay == None:
+            return result
+
+    register_request_failure(url)
     return None
 
 # Retrieve an image from URL and save it to a file
 def save_image(url: str, filename: str) -> bool:
-    r = get_response(url)
+    r = get_response(url, stream=True)
+    if r == None:
+        return False
 
     try:
-        with open(filename, 'wb') as f:
-            f.write(r.content)
+        with r, open(filename, 'wb') as f:
+            for chunk in r.iter_content(IMAGE_CHUNK_SIZE):
+                f.write(chunk)
     except OSError:
         logging.error('Can\'t save an image to the disk.')
         return False
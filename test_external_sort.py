@@ -0,0 +1,63 @@
+import os
+import random
+
+import pytest
+
+from external_sort import SortedItems
+
+class Record():
+    def __init__(self, name: str, index: int):
+        self.name = name
+        self.index = index
+
+    @classmethod
+    def from_dict(cls, item: dict) -> 'Record':
+        return cls(item['name'], item['index'])
+
+    def to_dict(self) -> dict:
+        return {'name': self.name, 'index': self.index}
+
+def make_items(count: int) -> list:
+    rng = random.Random(1)
+    return [{'name': rng.choice('abcde'), 'index': index}
+            for index in range(count)]
+
+def sort_key(item) -> str:
+    return item['name']
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 100, 1000])
+def test_sort_is_stable(tmp_path, chunk_size):
+    items = make_items(100)
+    with SortedItems(items, sort_key, chunk_size=chunk_size,
+                     temp_dir=str(tmp_path)) as sorted_items:
+        assert list(sorted_items) == sorted(items, key=sort_key)
+
+def test_runs_can_be_iterated_again(tmp_path):
+    items = make_items(50)
+    with SortedItems(items, sort_key, chunk_size=10,
+                     temp_dir=str(tmp_path)) as sorted_items:
+        assert list(sorted_items) == list(sorted_items)
+
+def test_records_are_restored(tmp_path):
+    records = [Record(item['name'], item['index'])
+               for item in make_items(30)]
+    key = lambda record: record.name
+    with SortedItems(records, key, chunk_size=4, temp_dir=str(tmp_path),
+                     item_factory=Record.from_dict) as sorted_items:
+        result = list(sorted_items)
+    assert all(isinstance(record, Record) for record in result)
+    assert [record.to_dict() for record in result] == [
+        record.to_dict() for record in sorted(records, key=key)]
+
+def test_temporary_files_are_removed(tmp_path):
+    with SortedItems(make_items(20), sort_key, chunk_size=5,
+                     temp_dir=str(tmp_path)):
+        assert len(os.listdir(tmp_path)) == 1
+    assert os.listdir(tmp_path) == []
+
+def test_small_input_is_sorted_in_memory(tmp_path):
+    with SortedItems(make_items(20), sort_key,
+                     temp_dir=str(tmp_path)) as sorted_items:
+        assert sorted_items.runs == []
+        assert os.listdir(tmp_path) == []
+        assert len(list(sorted_items)) == 20
@@ -0,0 +1,68 @@
+import time
+
+import pytest
+
+from filter_planner import FilterPlanner
+
+API_LINK = 'https://zoon.ru/msk/entertainment/?action=listJson&type=service'
+
+@pytest.fixture
+def planner(tmp_path):
+    with FilterPlanner(str(tmp_path / 'filters.sqlite'),
+                       skip_after_walks=2, recheck_age=60) as planner:
+        yield planner
+
+def test_unknown_filters_go_first(planner):
+    planner.record(API_LINK, 'm[1]', pages=4, new_count=40)
+    planner.record(API_LINK, 'm[2]', pages=2, new_count=40)
+    assert planner.plan(API_LINK, ['m[1]', 'm[2]', 'm[3]']) == [
+        'm[3]', 'm[2]', 'm[1]']
+
+def test_yield_is_accumulated(planner):
+    assert planner.get_yield(API_LINK, 'm[1]') == float('inf')
+    planner.record(API_LINK, 'm[1]', pages=2, new_count=10)
+    planner.record(API_LINK, 'm[1]', pages=3, new_count=0)
+    assert planner.get_yield(API_LINK, 'm[1]') == 2
+    entry = planner.get(API_LINK, 'm[1]')
+    assert entry['walks'] == 2
+    assert entry['pages'] == 5
+
+def test_filter_without_new_items_is_skipped(planner):
+    planner.record(API_LINK, 'm[1]', pages=1, new_count=0)
+    assert not planner.is_skipped(API_LINK, 'm[1]')
+    planner.record(API_LINK, 'm[1]', pages=1, new_count=0)
+    assert planner.is_skipped(API_LINK, 'm[1]')
+    assert planner.plan(API_LINK, ['m[1]', 'm[2]']) == ['m[2]']
+
+def test_new_items_reset_empty_walks(planner):
+    planner.record(API_LINK, 'm[1]', pages=1, new_count=0)
+    planner.record(API_LINK, 'm[1]', pages=1, new_count=3)
+    planner.record(API_LINK, 'm[1]', pages=1, new_count=0)
+    assert not planner.is_skipped(API_LINK, 'm[1]')
+
+def test_skipped_filter_is_rechecked(tmp_path):
+    with FilterPlanner(str(tmp_path / 'filters.sqlite'),
+                       skip_after_walks=2, recheck_age=0.05) as planner:
+        planner.record(API_LINK, 'm[1]', pages=1, new_count=0)
+        planner.record(API_LINK, 'm[1]', pages=1, new_count=0)
+        assert planner.is_skipped(API_LINK, 'm[1]')
+        time.sleep(0.1)
+        assert not planner.is_skipped(API_LINK, 'm[1]')
+
+        # An empty recheck does not skip the filter for another period
+        planner.record(API_LINK, 'm[1]', pages=1, new_count=0)
+        assert planner.get(API_LINK, 'm[1]')['empty_walks'] == 1
+        assert not planner.is_skipped(API_LINK, 'm[1]')
+
+def test_saturated_flag(planner):
+    planner.record(API_LINK, 'm[1]', pages=8, new_count=240, saturated=True)
+    assert planner.get(API_LINK, 'm[1]')['saturated']
+    planner.record(API_LINK, 'm[1]', pages=3, new_count=0)
+    assert not planner.get(API_LINK, 'm[1]')['saturated']
+
+def test_stats_are_persisted(tmp_path):
+    filename = str(tmp_path / 'filters.sqlite')
+    with FilterPlanner(filename) as planner:
+        planner.record(API_LINK, 'm[1]', pages=2, new_count=6)
+    with FilterPlanner(filename) as planner:
+        assert planner.get_yield(API_LINK, 'm[1]') == 3
@@ -0,0 +1,75 @@
+import sqlite3
+
+import pytest
+
+from frontier import CrawlFrontier
+
+API_LINK = 'https://zoon.ru/msk/entertainment/?action=listJson&type=service'
+
+@pytest.fixture
+def frontier(tmp_path):
+    with CrawlFrontier(str(tmp_path / 'frontier.sqlite')) as frontier:
+        yield frontier
+
+def test_pages_are_resumed(frontier):
+    assert frontier.get_next_page(API_LINK, 'm[1]') == 1
+    assert frontier.get_progress(API_LINK, 'm[1]') == (0, 0, False)
+
+    frontier.mark_page_done(API_LINK, 'm[1]', 1, 30)
+    frontier.mark_page_done(API_LINK, 'm[1]', 2, 12, last=True)
+    assert frontier.get_next_page(API_LINK, 'm[1]') == 3
+    assert frontier.get_progress(API_LINK, 'm[1]') == (2, 42, True)
+    assert frontier.get_next_page(API_LINK, 'm[2]') == 1
+
+def test_page_is_recorded_once(frontier):
+    frontier.mark_page_done(API_LINK, 'm[1]', 1, 30)
+    frontier.mark_page_done(API_LINK, 'm[1]', 1, 5)
+    assert frontier.get_progress(API_LINK, 'm[1]') == (1, 5, False)
+
+def test_filters(frontier):
+    assert not frontier.is_filter_done(API_LINK, 'm[1]')
+    frontier.mark_filter_done(API_LINK, 'm[1]')
+    frontier.mark_filter_done(API_LINK, 'm[1]')
+    assert frontier.is_filter_done(API_LINK, 'm[1]')
+    assert not frontier.is_filter_done(API_LINK, 'm[2]')
+
+def test_pending(frontier):
+    frontier.add_pending(['https://zoon.ru/a/', 'https://zoon.ru/b/'])
+    frontier.add_pending(['https://zoon.ru/a/'])
+    frontier.remove_pending(['https://zoon.ru/b/'])
+    assert frontier.get_pending() == ['https://zoon.ru/a/']
+
+def test_progress_is_persisted(tmp_path):
+    filename = str(tmp_path / 'frontier.sqlite')
+    with CrawlFrontier(filename) as frontier:
+        frontier.mark_page_done(API_LINK, 'm[1]', 1, 30)
+        frontier.mark_filter_done(API_LINK, 'm[2]')
+        frontier.add_pending(['https://zoon.ru/a/'])
+    with CrawlFrontier(filename) as frontier:
+        assert frontier.get_next_page(API_LINK, 'm[1]') == 2
+        assert frontier.is_filter_done(API_LINK, 'm[2]')
+        assert frontier.get_pending() == ['https://zoon.ru/a/']
+
+def test_reset(frontier):
+    frontier.mark_page_done(API_LINK, 'm[1]', 1, 30)
+    frontier.mark_filter_done(API_LINK, 'm[1]')
+    frontier.add_pending(['https://zoon.ru/a/'])
+    frontier.reset()
+    assert frontier.get_next_page(API_LINK, 'm[1]') == 1
+    assert not frontier.is_filter_done(API_LINK, 'm[1]')
+    assert frontier.get_pending() == []
+
+def test_old_file_is_migrated(tmp_path):
+    filename = str(tmp_path / 'frontier.sqlite')
+    db = sqlite3.connect(filename)
+    db.execute('CREATE TABLE pages (api_link TEXT NOT NULL, '
+               'item_filter TEXT NOT NULL, page INTEGER NOT NULL, '
+               'PRIMARY KEY (api_link, item_filter, page))')
+    db.execute('INSERT INTO pages VALUES (?, ?, ?)', (API_LINK, 'm[1]', 1))
+    db.commit()
+    db.close()
+
+    with CrawlFrontier(filename) as frontier:
+        assert frontier.get_progress(API_LINK, 'm[1]') == (1, 0, False)
+        frontier.mark_page_done(API_LINK, 'm[1]', 2, 7, last=True)
+        assert frontier.get_progress(API_LINK, 'm[1]') == (2, 7, True)
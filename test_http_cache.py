@@ -0,0 +1,127 @@
+import time
+
+import pytest
+import requests
+
+import scraping_utils
+from http_cache import (ResponseCache, build_response,
+                        get_conditional_headers)
+
+def make_response(url: str, body: bytes, headers: dict=None,
+                  status: int=200) -> requests.Response:
+    r = requests.Response()
+    r.status_code = status
+    r.url = url
+    r.headers.update(headers or {})
+    r._content = body
+    return r
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'))
+    yield cache
+    cache.close()
+
+def test_key_ignores_params_order():
+    first = ResponseCache.make_key('post', 'https://zoon.ru/',
+                                   {'a': 1, 'b': 2})
+    second = ResponseCache.make_key('POST', 'https://zoon.ru/',
+                                    {'b': 2, 'a': 1})
+    assert first == second
+    assert first != ResponseCache.make_key('GET', 'https://zoon.ru/',
+                                           {'a': 1, 'b': 2})
+
+def test_put_and_build_response(cache):
+    key = cache.make_key('GET', 'https://zoon.ru/msk/')
+    cache.put(key, make_response(
+        'https://zoon.ru/msk/', 'Привет'.encode('utf-8'),
+        {'Content-Type': 'text/html; charset=utf-8', 'ETag': '"abc"'}))
+
+    r = build_response(cache.get(key))
+    assert r.status_code == 200
+    assert r.text == 'Привет'
+    assert r.headers['content-type'] == 'text/html; charset=utf-8'
+    assert r.from_cache
+
+def test_missing_key(cache):
+    assert cache.get('unknown') == None
+
+def test_delete(cache):
+    key = cache.make_key('GET', 'https://zoon.ru/')
+    cache.put(key, make_response('https://zoon.ru/', b'captcha'))
+    cache.delete(key)
+    assert cache.get(key) == None
+
+def test_freshness_and_touch(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'), ttl=0.05)
+    try:
+        key = cache.make_key('GET', 'https://zoon.ru/')
+        cache.put(key, make_response('https://zoon.ru/', b'body'))
+        assert cache.is_fresh(cache.get(key))
+        time.sleep(0.1)
+        assert not cache.is_fresh(cache.get(key))
+        cache.touch(key)
+        assert cache.is_fresh(cache.get(key))
+    finally:
+        cache.close()
+
+def test_conditional_headers(cache):
+    key = cache.make_key('GET', 'https://zoon.ru/')
+    cache.put(key, make_response(
+        'https://zoon.ru/', b'body',
+        {'ETag': '"abc"', 'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'}))
+    assert get_conditional_headers(cache.get(key)) == {
+        'If-None-Match': '"abc"',
+        'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT',
+    }
+
+    key = cache.make_key('GET', 'https://zoon.ru/spb/')
+    cache.put(key, make_response('https://zoon.ru/spb/', b'body'))
+    assert get_conditional_headers(cache.get(key)) == {}
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'), max_size=1)
+    try:
+        keys = [cache.make_key('GET', f'https://zoon.ru/{index}/')
+                for index in range(3)]
+        for key in keys:
+            cache.put(key, make_response('https://zoon.ru/', b'x' * 100))
+            time.sleep(0.01)
+        cache.get(keys[0])
+        cache.max_size = cache.get(keys[0])['size'] * 2
+        cache.evict()
+        assert cache.get(keys[0]) != None
+        assert cache.get(keys[1]) == None
+        assert cache.get(keys[2]) != None
+    finally:
+        cache.close()
+
+@pytest.fixture
+def shared_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(scraping_utils, 'USE_CACHE', True)
+    monkeypatch.setattr(scraping_utils, '_cache',
+                        ResponseCache(str(tmp_path / 'cache.sqlite')))
+    yield scraping_utils.get_cache()
+    scraping_utils.close_cache()
+
+def test_response_is_cached_after_validation(shared_cache, monkeypatch):
+    calls = []
+    def fake_get_response(url, *args, **kwargs):
+        calls.append(url)
+        return make_response(url, b'{"html": ""}')
+    monkeypatch.setattr(scraping_utils, '_get_response', fake_get_response)
+
+    r = scraping_utils.get_response('https://zoon.ru/')
+    assert not r.from_cache
+    # Nothing is stored until the caller validates the response
+    assert scraping_utils.get_response('https://zoon.ru/') != None
+    assert len(calls) == 2
+
+    scraping_utils.cache_response(r)
+    r = scraping_utils.get_response('https://zoon.ru/')
+    assert r.from_cache
+    assert len(calls) == 2
+
+    scraping_utils.uncache_response(r)
+    assert not scraping_utils.get_response('https://zoon.ru/').from_cache
+    assert len(calls) == 3
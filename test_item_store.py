@@ -0,0 +1,64 @@
+import pytest
+
+import item_store
+from item_store import ItemStore
+
+@pytest.fixture
+def filename(tmp_path):
+    return str(tmp_path / 'items.jsonl')
+
+def write(filename: str, data: bytes):
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+def read(filename: str) -> bytes:
+    with open(filename, 'rb') as f:
+        return f.read()
+
+def test_items_are_appended(filename):
+    with ItemStore(filename, fsync=False) as store:
+        store.append({'url': 'a'})
+        store.extend([{'url': 'b'}, {'url': 'c'}])
+    assert ItemStore(filename).load() == [
+        {'url': 'a'}, {'url': 'b'}, {'url': 'c'}]
+
+def test_last_version_is_loaded(filename):
+    with ItemStore(filename, fsync=False,
+                   key=lambda item: item['url']) as store:
+        store.extend([{'url': 'a', 'name': 'first'}, {'url': 'b'},
+                      {'url': 'a', 'name': 'second'}])
+        assert store.load() == [{'url': 'b'},
+                                {'url': 'a', 'name': 'second'}]
+
+def test_item_factory(filename):
+    with ItemStore(filename, fsync=False, item_factory=tuple) as store:
+        store.append({'url': 'a'})
+        assert store.load() == [('url',)]
+
+def test_corrupted_line_is_skipped(filename):
+    write(filename, b'{"url": "a"}\n{"url": \n{"url": "b"}\n')
+    assert ItemStore(filename).load() == [{'url': 'a'}, {'url': 'b'}]
+
+def test_incomplete_last_line_is_cut_off(filename):
+    write(filename, b'{"url": "a"}\n{"url": "b"')
+    with ItemStore(filename, fsync=False) as store:
+        assert store.load() == [{'url': 'a'}]
+        store.append({'url': 'c'})
+    assert read(filename) == b'{"url": "a"}\n{"url": "c"}\n'
+
+def test_long_incomplete_line_is_cut_off(filename, monkeypatch):
+    monkeypatch.setattr(item_store, 'TAIL_CHUNK_SIZE', 4)
+    write(filename, b'{"url": "a"}\n{"url": "' + b'b' * 100)
+    with ItemStore(filename, fsync=False) as store:
+        store.append({'url': 'c'})
+    assert read(filename) == b'{"url": "a"}\n{"url": "c"}\n'
+
+def test_single_incomplete_line_is_cut_off(filename, monkeypatch):
+    monkeypatch.setattr(item_store, 'TAIL_CHUNK_SIZE', 4)
+    write(filename, b'{"url": "' + b'b' * 100)
+    with ItemStore(filename, fsync=False) as store:
+        store.append({'url': 'c'})
+    assert read(filename) == b'{"url": "c"}\n'
+
+def test_missing_file(filename):
+    assert ItemStore(filename).load() == []
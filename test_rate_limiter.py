@@ -0,0 +1,87 @@
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import rate_limiter
+from rate_limiter import TokenBucket, HostRateLimiter, backoff_delay
+from scraping_utils import get_retry_after
+
+class Clock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limiter, 'time',
+                        SimpleNamespace(monotonic=clock))
+    return clock
+
+def test_burst_then_rate(clock):
+    bucket = TokenBucket(rate=2, capacity=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.5)
+
+    clock.now += 0.25
+    assert bucket.reserve() == pytest.approx(0.25)
+    clock.now += 0.25
+    assert bucket.reserve() == 0
+
+def test_idle_bucket_is_capped(clock):
+    bucket = TokenBucket(rate=2, capacity=2)
+    clock.now += 100
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() > 0
+
+def test_set_rate_keeps_earned_tokens(clock):
+    bucket = TokenBucket(rate=1, capacity=1)
+    bucket.reserve()
+    clock.now += 0.5
+    bucket.set_rate(10)
+    assert bucket.tokens == pytest.approx(0.5)
+    assert bucket.reserve() == pytest.approx(0.05)
+
+def test_aimd_bounds(clock):
+    limiter = HostRateLimiter(initial_rate=1, min_rate=0.2, max_rate=1.5,
+                              increase=0.25, decrease=0.5)
+    url = 'https://zoon.ru/msk/'
+    for _ in range(10):
+        limiter.speed_up(url)
+    assert limiter.get_rate(url) == 1.5
+
+    limiter.slow_down(url)
+    assert limiter.get_rate(url) == 0.75
+    for _ in range(10):
+        limiter.slow_down(url)
+    assert limiter.get_rate(url) == 0.2
+
+def test_hosts_are_limited_separately(clock):
+    limiter = HostRateLimiter(initial_rate=1, burst=1)
+    assert limiter.reserve('https://zoon.ru/msk/') == 0
+    assert limiter.reserve('https://zoon.ru/spb/') > 0
+    assert limiter.reserve('https://spb.zoon.ru/') == 0
+    limiter.slow_down('https://spb.zoon.ru/')
+    assert limiter.get_rate('https://zoon.ru/') == 1
+
+def test_backoff_delay(monkeypatch):
+    monkeypatch.setattr(rate_limiter.random, 'uniform',
+                        lambda low, high: high)
+    assert [backoff_delay(attempt) for attempt in range(4)] == [1, 2, 4, 8]
+    assert backoff_delay(10) == rate_limiter.BACKOFF_MAX
+    assert backoff_delay(3, base=0.5, maximum=3) == 3
+
+@pytest.mark.parametrize('header, delay', [
+    (None, None), ('soon', None), ('5', 5), ('-3', 0),
+    ('100000', rate_limiter.BACKOFF_MAX),
+])
+def test_retry_after_is_clamped(header, delay):
+    r = requests.Response()
+    if header != None:
+        r.headers['Retry-After'] = header
+    assert get_retry_after(r) == delay
@@ -0,0 +1,69 @@
+import pytest
+
+from metrics import METRICS
+from url_index import BloomFilter, SeenIndex, normalize_url
+
+@pytest.mark.parametrize('url', [
+    'https://zoon.ru/msk/entertainment/park/',
+    'https://zoon.ru/msk/entertainment/park',
+    'HTTPS://ZOON.RU/msk/entertainment/park/?utm_source=listing',
+    '  https://zoon.ru/msk/entertainment/park#photos ',
+])
+def test_normalize_url(url):
+    assert normalize_url(url) == 'https://zoon.ru/msk/entertainment/park/'
+
+def test_normalize_url_keeps_path_case():
+    assert normalize_url('https://zoon.ru/msk/Park') != normalize_url(
+        'https://zoon.ru/msk/park')
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000)
+    keys = [f'https://zoon.ru/{index}/' for index in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+    assert len(bloom) <= 1000
+
+    misses = sum(f'https://zoon.ru/new/{index}/' in bloom
+                 for index in range(10000))
+    # 0.1% expected at the capacity
+    assert misses < 50
+    assert 0 < bloom.get_error_rate() < 0.002
+
+@pytest.mark.parametrize('bloom_capacity', [None, 1000])
+def test_add_and_contains(bloom_capacity):
+    seen = SeenIndex(['https://zoon.ru/a/'], bloom_capacity=bloom_capacity)
+    assert 'https://zoon.ru/a?page=2' in seen
+    assert seen.add('https://zoon.ru/b')
+    assert not seen.add('https://zoon.ru/b/')
+    assert 'https://zoon.ru/c/' not in seen
+    assert len(seen) == 2
+
+def test_index_is_reloaded(tmp_path):
+    filename = str(tmp_path / 'seen.txt')
+    seen = SeenIndex(filename=filename)
+    seen.add('https://zoon.ru/a')
+    seen.add('https://zoon.ru/b/?x=1')
+    seen.close()
+    # A line torn by a crash is ignored
+    with open(filename, 'a', encoding='utf-8') as f:
+        f.write('https://zoon.ru/c/')
+
+    seen = SeenIndex(['https://zoon.ru/d/'], filename=filename)
+    try:
+        assert 'https://zoon.ru/a/' in seen
+        assert 'https://zoon.ru/b/' in seen
+        assert 'https://zoon.ru/c/' not in seen
+        assert len(seen) == 3
+    finally:
+        seen.close()
+
+def test_bloom_false_positives_are_estimated():
+    METRICS.reset()
+    seen = SeenIndex(bloom_capacity=10)
+    for index in range(12):
+        seen.add(f'https://zoon.ru/{index}/')
+    assert 'https://zoon.ru/1/' in seen
+    estimate = METRICS.get_counters()[
+        ('items', (('result', 'false_positive'),))]
+    assert estimate == pytest.approx(seen.keys.get_error_rate())
@@ -0,0 +1,71 @@
+import time
+
+import pytest
+
+from work_queue import WorkQueue, PENDING, LEASED, DONE, FAILED
+
+@pytest.fixture
+def queue(tmp_path):
+    with WorkQueue(str(tmp_path / 'queue.sqlite'), lease_time=60,
+                   max_attempts=2) as queue:
+        yield queue
+
+def make_task(key: str, priority: int=0) -> tuple:
+    return key, 'listing', {'key': key}, priority
+
+def test_keys_are_unique(queue):
+    assert queue.add([make_task('a'), make_task('b')]) == 2
+    assert queue.add([make_task('a'), make_task('c')]) == 1
+    assert queue.get_counts()[PENDING] == 3
+
+def test_claim_by_priority(queue):
+    queue.add([make_task('low'), make_task('high', priority=1)])
+    task = queue.claim('worker')
+    assert task['key'] == 'high'
+    assert task['payload'] == {'key': 'high'}
+    assert task['attempts'] == 1
+    assert queue.claim('worker')['key'] == 'low'
+    assert queue.claim('worker') == None
+    assert queue.get_counts()[LEASED] == 2
+
+def test_done_keys_are_not_claimed(queue):
+    queue.add([make_task('known')], state=DONE)
+    assert queue.claim('worker') == None
+    assert queue.is_finished()
+
+def test_complete_saves_result_and_new_tasks(queue):
+    queue.add([make_task('a')])
+    task = queue.claim('worker')
+    assert queue.complete(task, 'worker', {'item': 1}, [make_task('b')])
+    assert list(queue.get_results()) == [(1, {'item': 1})]
+    assert list(queue.get_results(1)) == []
+    assert queue.claim('worker')['key'] == 'b'
+
+def test_expired_lease_is_claimed_again(tmp_path):
+    with WorkQueue(str(tmp_path / 'queue.sqlite'),
+                   lease_time=0.05) as queue:
+        queue.add([make_task('a')])
+        task = queue.claim('dead')
+        assert queue.claim('alive') == None
+        time.sleep(0.1)
+        assert queue.claim('alive')['attempts'] == 2
+        # The lease is lost, so the dead worker result is dropped
+        assert not queue.complete(task, 'dead', {'item': 1})
+        assert list(queue.get_results()) == []
+
+def test_failed_task_runs_out_of_attempts(queue):
+    queue.add([make_task('a')])
+    queue.fail(queue.claim('worker'), 'worker')
+    assert queue.get_counts()[PENDING] == 1
+    queue.fail(queue.claim('worker'), 'worker')
+    assert queue.get_counts()[FAILED] == 1
+    assert queue.is_finished()
+
+def test_release_keeps_attempts(queue):
+    queue.add([make_task('a')])
+    for _ in range(3):
+        task = queue.claim('worker')
+        assert task['attempts'] == 1
+        assert queue.release(task, 'worker')
+    assert queue.get_counts()[PENDING] == 1
+    assert not queue.release(task, 'other')
@@ -1,43 +1,155 @@
-import subprocess
+import os
 import time
+import socket
+import logging
+import threading
+import subprocess
 
 import requests
 
-TOR_EXECUTABLE_PATH = 'C:/Tor/Tor/tor.exe'
+TOR_EXECUTABLE_PATH = '/usr/bin/tor'
+
+TOR_SOCKS_PORT = 9050
+TOR_CONTROL_PORT = 9051
 
+# socks5h scheme means host names are resolved by Tor, not by local DNS
 TOR_SOCKS_PROXIES = {
-    'http': 'socks5://localhost:9050',
-    'https': 'socks5://localhost:9050'
+    'http': f'socks5h://localhost:{TOR_SOCKS_PORT}',
+    'https': f'socks5h://localhost:{TOR_SOCKS_PORT}'
 }
 
-TOR_STARTUP_TIME = 15
+# Maximum time for Tor bootstrapping (seconds)
+TOR_STARTUP_TIMEOUT = 120
+
+# Line in Tor output which means the proxy is ready
+TOR_READY_MARKER = 'Bootstrapped 100%'
+
+# Directory for Tor instances data (each instance has its own subdirectory)
+TOR_DATA_FOLDER = 'tor_data'
+
+# Tor does not change circuits more often than once per this time (seconds)
+NEWNYM_INTERVAL = 10
+
+# The time a blocked circuit is not used after NEWNYM signal (seconds)
+BLOCK_COOLDOWN = NEWNYM_INTERVAL
+
+# Consecutive failures after which Tor instance is restarted
+MAX_FAILURES = 5
+
+# Maximum time of waiting for a healthy Tor instance (seconds)
+PROXY_WAIT_TIMEOUT = 60
 
 HTTP_BIN_HOST = 'https://httpbin.org/'
 
 class TorProxy():
-    def __init__(self, executable_path: str=TOR_EXECUTABLE_PATH):
+    def __init__(self, executable_path: str=TOR_EXECUTABLE_PATH,
+                 socks_port: int=TOR_SOCKS_PORT,
+                 control_port: int=TOR_CONTROL_PORT, data_dir: str=None):
         self.executable_path = executable_path
+        self.socks_port = socks_port
+        self.control_port = control_port
+        self.data_dir = data_dir
         self.process = None
+        self.output = []
+        self.ready = threading.Event()
+        self.proxies = {
+            'http': f'socks5h://localhost:{socks_port}',
+            'https': f'socks5h://localhost:{socks_port}',
+        }
+
+    def get_args(self) -> list:
+        args = [self.executable_path,
+                '--SocksPort', str(self.socks_port),
+                '--ControlPort', str(self.control_port)]
+        if self.data_dir != None:
+            args += ['--DataDirectory', self.data_dir]
+
+        return args
+
+    # Collects Tor output until the process exits, detects readiness
+    def _read_output(self, process: subprocess.Popen):
+        for line in process.stdout:
+            line = line.decode('ascii', 'ignore').rstrip()
+            self.output.append(line)
+            if TOR_READY_MARKER in line:
+                self.ready.set()
 
     def restart(self, wait: bool=False) -> bool:
         self.terminate()
-        self.process = subprocess.Popen(args=[self.executable_path],
-                                        stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE)
+        if self.data_dir != None:
+            os.makedirs(self.data_dir, exist_ok=True)
+
+        self.output = []
+        self.ready.clear()
+        try:
+            self.process = subprocess.Popen(args=self.get_args(),
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT)
+        except OSError as e:
+            logging.error(f'Can\'t start Tor: {e}')
+            self.process = None
+            return False
+        threading.Thread(target=self._read_output, args=(self.process,),
+                         daemon=True).start()
+
         if wait:
-            time.sleep(TOR_STARTUP_TIME)
+            return self.wait_ready()
+
+        return True
+
+    def wait_ready(self, timeout: float=TOR_STARTUP_TIMEOUT) -> bool:
+        """Waits for Tor bootstrapping instead of a fixed delay."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.ready.wait(0.5):
+                return True
+            if not self.is_running():
+                return False
+
+        return False
 
     def is_running(self) -> bool:
         return self.process != None and self.process.poll() == None
 
+    def is_ready(self) -> bool:
+        return self.is_running() and self.ready.is_set()
+
     def terminate(self):
         if self.is_running():
             self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+    def new_identity(self) -> bool:
+        """Sends NEWNYM signal via the control port, so new requests are
+        routed through new circuits (and most likely new exit nodes).
+        """
+        try:
+            with socket.create_connection(('localhost', self.control_port),
+                                          timeout=5) as control:
+                control.sendall(b'AUTHENTICATE ""\r\nSIGNAL NEWNYM\r\n')
+                reply = control.recv(1024).decode('ascii', 'ignore')
+                # The second reply may come in a separate packet
+                if reply.count('250') < 2:
+                    reply += control.recv(1024).decode('ascii', 'ignore')
+        except OSError as e:
+            logging.error(f'Tor control port {self.control_port} '
+                          f'failure: {e}')
+            return False
+
+        if reply.count('250') < 2:
+            logging.error(f'NEWNYM failed for Tor port {self.socks_port}: '
+                          + reply.strip())
+            return False
+
+        return True
 
     def test_ok(self) -> bool:
         if self.is_running():
             try:
-                r = requests.get(HTTP_BIN_HOST, proxies=TOR_SOCKS_PROXIES)
+                r = requests.get(HTTP_BIN_HOST, proxies=self.proxies)
             except requests.exceptions.RequestException:
                 return False
 
@@ -49,7 +161,93 @@ class TorProxy():
         return False
 
     def get_output(self) -> str:
-        if self.process != None and self.process.poll() != None:
-            return self.process.stdout.read().decode('ascii', 'ignore')
-        else:
-            return None
+        return '\n'.join(self.output)
+
+class TorPool():
+    """Pool of Tor instances with distinct SOCKS ports and data directories.
+
+    get_proxy() spreads requests over healthy instances in turn. Blocked
+    instances get new circuits and are not used until the cooldown expires,
+    instances failing repeatedly are restarted.
+    """
+    def __init__(self, size: int, executable_path: str=TOR_EXECUTABLE_PATH,
+                 base_socks_port: int=TOR_SOCKS_PORT,
+                 base_control_port: int=TOR_CONTROL_PORT + 1000,
+                 data_folder: str=TOR_DATA_FOLDER):
+        self.proxies = [
+            TorProxy(executable_path, base_socks_port + index,
+                     base_control_port + index,
+                     os.path.join(data_folder, str(index)))
+            for index in range(size)]
+        # Proxy -> time until which it is not used
+        self.cooldowns = {}
+        self.failures = {}
+        self.index = 0
+        self.lock = threading.Lock()
+
+    def start(self) -> bool:
+        for proxy in self.proxies:
+            proxy.restart()
+
+        ready = [proxy for proxy in self.proxies if proxy.wait_ready()]
+        logging.info(f'{len(ready)} of {len(self.proxies)} Tor instances '
+                     'are ready.')
+        return len(ready) > 0
+
+    def stop(self):
+        for proxy in self.proxies:
+            proxy.terminate()
+
+    def is_healthy(self, proxy: TorProxy) -> bool:
+        return (proxy.is_ready()
+                and self.cooldowns.get(proxy, 0) <= time.monotonic())
+
+    def get_proxy(self, timeout: float=PROXY_WAIT_TIMEOUT) -> TorProxy:
+        """Returns the next healthy instance. If there is none, waits for the
+        nearest cooldown expiration or for instances being (re)started.
+        Returns None if no instance is healthy within the timeout, the
+        request should not be made then.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                for _ in range(len(self.proxies)):
+                    proxy = self.proxies[self.index]
+                    self.index = (self.index + 1) % len(self.proxies)
+                    if self.is_healthy(proxy):
+                        return proxy
+
+                now = time.monotonic()
+                if now >= deadline:
+                    logging.error('No healthy Tor instance available.')
+                    return None
+                ready = [proxy for proxy in self.proxies if proxy.is_ready()]
+                delay = 0.5
+                if ready:
+                    delay = min(self.cooldowns.get(proxy, 0)
+                                for proxy in ready) - now
+            time.sleep(min(max(delay, 0.1), deadline - now))
+
+    def report_success(self, proxy: TorProxy):
+        with self.lock:
+            self.failures[proxy] = 0
+
+    def report_failure(self, proxy: TorProxy):
+        with self.lock:
+            self.failures[proxy] = self.failures.get(proxy, 0) + 1
+            restart = self.failures[proxy] >= MAX_FAILURES
+            if restart:
+                self.failures[proxy] = 0
+        if restart:
+            logging.warning(f'Restarting Tor on port {proxy.socks_port}.')
+            proxy.restart(wait=True)
+
+    # The exit node is blocked: switching to new circuits
+    def report_blocked(self, proxy: TorProxy):
+        with self.lock:
+            if self.cooldowns.get(proxy, 0) > time.monotonic():
+                return
+            self.cooldowns[proxy] = time.monotonic() + BLOCK_COOLDOWN
+        logging.info(f'Tor exit on port {proxy.socks_port} blocked, '
+                     'requesting new circuits.')
+        proxy.new_identity()
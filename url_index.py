@@ -0,0 +1,153 @@
+"""Index of already fetched item URLs with O(1) lookups.
+
+URLs are normalised before indexing, so the same item found under different
+filters or with different query strings is recognised. The index may be
+persisted to an append-only text file and, for very large runs, may keep its
+entries in a Bloom filter instead of a set (false positives are possible, so
+a small share of new items may be skipped). In Bloom mode the expected count
+of false positives is exported as items{result="false_positive"} metric
+(every hit adds the current false positive rate of the filter), and the
+index warns when it grows beyond the capacity of the filter.
+"""
+import math
+import hashlib
+import logging
+import threading
+from urllib.parse import urlsplit, urlunsplit
+
+from metrics import METRICS
+
+# Default false positive rate for the Bloom filter
+BLOOM_ERROR_RATE = 0.001
+
+def normalize_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    path = parts.path or '/'
+    if not path.endswith('/'):
+        path += '/'
+
+    return urlunsplit((parts.scheme.lower() or 'https',
+                       parts.netloc.lower(), path, '', ''))
+
+class BloomFilter():
+    def __init__(self, capacity: int, error_rate: float=BLOOM_ERROR_RATE):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate)
+                               / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        for index in range(self.hash_count):
+            yield (first + index * second) % self.size
+
+    def add(self, key: str) -> bool:
+        added = False
+        for position in self._positions(key):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+
+        return added
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+    def __len__(self) -> int:
+        return self.count
+
+    # Expected false positive rate for the current count of keys
+    def get_error_rate(self) -> float:
+        return (1 - math.exp(-self.hash_count * self.count
+                             / self.size)) ** self.hash_count
+
+class SeenIndex():
+    def __init__(self, urls: list=(), filename: str=None,
+                 bloom_capacity: int=None,
+                 error_rate: float=BLOOM_ERROR_RATE):
+        self.bloom = bool(bloom_capacity)
+        if self.bloom:
+            self.keys = BloomFilter(bloom_capacity, error_rate)
+        else:
+            self.keys = set()
+        self.over_capacity = False
+        self.filename = filename
+        self.file = None
+        self.lock = threading.Lock()
+
+        for url in urls:
+            self.keys.add(normalize_url(url))
+
+        if filename != None:
+            self._load()
+        self._check_capacity()
+
+    def _load(self):
+        try:
+            with open(self.filename, encoding='utf-8') as f:
+                for line in f:
+                    if line.endswith('\n'):
+                        self.keys.add(line[:-1])
+        except FileNotFoundError:
+            pass
+        except OSError:
+            logging.warning(f"Can't load the file {self.filename}.")
+
+    # Any Bloom filter hit may be a false positive which skips a new item,
+    # their expected count is accumulated
+    def _contains(self, key: str) -> bool:
+        found = key in self.keys
+        if found and self.bloom:
+            METRICS.inc('items', self.keys.get_error_rate(),
+                        result='false_positive')
+        return found
+
+    # Warns once when the Bloom filter holds more keys than it was sized for
+    def _check_capacity(self):
+        if (not self.bloom or self.over_capacity
+                or len(self.keys) <= self.keys.capacity):
+            return
+        self.over_capacity = True
+        logging.warning(f'Seen URLs index exceeds its capacity of '
+                        f'{self.keys.capacity} URLs, expected false positive '
+                        f'rate is {self.keys.get_error_rate():.2%} now.')
+
+    def __contains__(self, url: str) -> bool:
+        return self._contains(normalize_url(url))
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def add(self, url: str) -> bool:
+        """Adds URL to the index. Returns False if it was already there."""
+        key = normalize_url(url)
+        with self.lock:
+            if self._contains(key):
+                return False
+            self.keys.add(key)
+            self._check_capacity()
+
+            if self.filename != None:
+                try:
+                    if self.file == None:
+                        self.file = open(self.filename, 'a', encoding='utf-8')
+                    self.file.write(key + '\n')
+                    self.file.flush()
+                except OSError:
+                    logging.error(f"Can't write to the file {self.filename}.")
+
+        return True
+
+    def close(self):
+        with self.lock:
+            if self.file != None:
+                self.file.close()
+                self.file = None
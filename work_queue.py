@@ -0,0 +1,220 @@
+"""Shared work queue for distributed crawling.
+
+Tasks and their results are kept in a single SQLite file which is opened by
+the coordinator and all the workers (on several machines it should be on a
+shared file system with working file locks). Every task has a unique key, so
+a listing page or an item found by several workers is queued only once.
+
+A worker claims a task for LEASE_TIME seconds. If the worker dies, the lease
+expires and the task is claimed by another worker. Failed tasks are retried
+until MAX_ATTEMPTS claims are made, a released task (not processed by the
+worker) does not spend its attempt. Results are stored together with
+completing their tasks in a single transaction.
+"""
+import json
+import time
+import sqlite3
+import threading
+
+QUEUE_FILENAME = 'work_queue.sqlite'
+
+# Time a claimed task is reserved for the worker (seconds), it should be
+# longer than the worst-case processing time of a task with all its retries
+LEASE_TIME = 120
+
+# Maximum claims of a task before it is considered failed
+MAX_ATTEMPTS = 5
+
+# Waiting time for the database lock held by other processes (seconds)
+LOCK_TIMEOUT = 60
+
+# Task states
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL
+);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, priority);
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    task_id INTEGER NOT NULL UNIQUE,
+    data TEXT NOT NULL
+);
+'''
+
+class WorkQueue():
+    def __init__(self, filename: str=QUEUE_FILENAME,
+                 lease_time: float=LEASE_TIME,
+                 max_attempts: int=MAX_ATTEMPTS):
+        self.filename = filename
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        # Transactions are controlled explicitly
+        self.db = sqlite3.connect(filename, timeout=LOCK_TIMEOUT,
+                                  check_same_thread=False,
+                                  isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        # Write lock is taken at once, so the processes starting at the
+        # same time wait for each other instead of failing
+        self.db.executescript('BEGIN IMMEDIATE;' + SCHEMA + 'COMMIT;')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _transaction(self, function, *args):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                result = function(*args)
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+        return result
+
+    def add(self, tasks: list, state: str=PENDING) -> int:
+        """Queues (key, kind, payload, priority) tuples, tasks with known
+        keys are ignored. Tasks added as DONE only reserve their keys.
+        Returns the count of new tasks.
+        """
+        def add():
+            count = self.db.total_changes
+            self.db.executemany(
+                'INSERT OR IGNORE INTO tasks '
+                '(key, kind, payload, priority, state) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(key, kind, json.dumps(payload, ensure_ascii=False),
+                  priority, state)
+                 for key, kind, payload, priority in tasks])
+            return self.db.total_changes - count
+
+        return self._transaction(add)
+
+    def claim(self, worker: str) -> dict:
+        """Leases the pending task with the highest priority (or a task with
+        expired lease). Returns the task dict with id, key, kind, payload and
+        attempts or None if there is nothing to do at the moment.
+        """
+        def claim():
+            now = time.time()
+            # Tasks of dead workers which ran out of attempts
+            self.db.execute(
+                'UPDATE tasks SET state = ? WHERE state = ? '
+                'AND lease_expires < ? AND attempts >= ?',
+                (FAILED, LEASED, now, self.max_attempts))
+            row = self.db.execute(
+                'SELECT * FROM tasks WHERE state = ? '
+                'OR (state = ? AND lease_expires < ?) '
+                'ORDER BY priority DESC, id LIMIT 1',
+                (PENDING, LEASED, now)).fetchone()
+            if row == None:
+                return None
+            self.db.execute(
+                'UPDATE tasks SET state = ?, attempts = attempts + 1, '
+                'lease_owner = ?, lease_expires = ? WHERE id = ?',
+                (LEASED, worker, now + self.lease_time, row['id']))
+            return {
+                'id': row['id'],
+                'key': row['key'],
+                'kind': row['kind'],
+                'payload': json.loads(row['payload']),
+                'attempts': row['attempts'] + 1,
+            }
+
+        return self._transaction(claim)
+
+    def complete(self, task: dict, worker: str, result=None,
+                 new_tasks: list=()) -> bool:
+        """Marks the task done, saves its result (if not None) and queues
+        the tasks found. Returns False if the lease was lost, then nothing is
+        changed: the task has been passed to another worker.
+        """
+        def complete():
+            cursor = self.db.execute(
+                'UPDATE tasks SET state = ?, lease_expires = NULL '
+                'WHERE id = ? AND state = ? AND lease_owner = ?',
+                (DONE, task['id'], LEASED, worker))
+            if cursor.rowcount == 0:
+                return False
+            if result != None:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO results (task_id, data) '
+                    'VALUES (?, ?)',
+                    (task['id'], json.dumps(result, ensure_ascii=False)))
+            self.db.executemany(
+                'INSERT OR IGNORE INTO tasks '
+                '(key, kind, payload, priority, state) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(key, kind, json.dumps(payload, ensure_ascii=False),
+                  priority, PENDING)
+                 for key, kind, payload, priority in new_tasks])
+            return True
+
+        return self._transaction(complete)
+
+    def fail(self, task: dict, worker: str):
+        """Returns the task to the queue or marks it failed if it has run out
+        of attempts.
+        """
+        state = FAILED if task['attempts'] >= self.max_attempts else PENDING
+        self._transaction(lambda: self.db.execute(
+            'UPDATE tasks SET state = ?, lease_expires = NULL '
+            'WHERE id = ? AND state = ? AND lease_owner = ?',
+            (state, task['id'], LEASED, worker)))
+
+    def release(self, task: dict, worker: str) -> bool:
+        """Returns the task to the queue without spending its attempt, e.g.
+        when its host is cooling down. Returns False if the lease was lost.
+        """
+        def release():
+            cursor = self.db.execute(
+                'UPDATE tasks SET state = ?, attempts = attempts - 1, '
+                'lease_owner = NULL, lease_expires = NULL '
+                'WHERE id = ? AND state = ? AND lease_owner = ?',
+                (PENDING, task['id'], LEASED, worker))
+            return cursor.rowcount > 0
+
+        return self._transaction(release)
+
+    # Yields (result id, result) tuples for results with greater ids
+    def get_results(self, after_id: int=0):
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT id, data FROM results WHERE id > ? ORDER BY id',
+                (after_id,)).fetchall()
+        for row in rows:
+            yield row['id'], json.loads(row['data'])
+
+    def get_counts(self) -> dict:
+        """Returns state -> task count dict."""
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT state, COUNT(*) FROM tasks GROUP BY state').fetchall()
+        counts = dict.fromkeys((PENDING, LEASED, DONE, FAILED), 0)
+        counts.update((state, count) for state, count in rows)
+        return counts
+
+    # No task is pending or being processed
+    def is_finished(self) -> bool:
+        counts = self.get_counts()
+        return counts[PENDING] == 0 and counts[LEASED] == 0
+
+    def close(self):
+        with self.lock:
+            self.db.close()
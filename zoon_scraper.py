@@ -3,25 +3,65 @@ essential information for all the objects for category 'entertament'.
 
 The results are saved to a CSV file.
 """
+import os
 import re
 import sys
 import csv
 import time
 import json
+import asyncio
 import logging
+import threading
+from contextlib import ExitStack
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from signal import signal, SIGINT
 from urllib.parse import unquote, urlparse
 
 import requests
 from bs4 import BeautifulSoup
-from bs4.element import NavigableString, Tag
-
-from scraping_utils import setup_logging, get_response, FATAL_ERROR_STR
+from bs4.element import NavigableString
+
+# lxml is much faster than the built-in parser, but it is optional
+try:
+    import lxml
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+# pyarrow is required only for the columnar export
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from item_store import ItemStore
+from url_index import SeenIndex
+from frontier import CrawlFrontier
+from external_sort import SortedItems
+from async_utils import AsyncFetcher, run_blocking
+from rate_limiter import backoff_delay
+from block_detector import CAPTCHA, JSON_ERROR, is_captcha
+from image_downloader import ImageDownloader
+from fetch_log import (FetchLog, get_fingerprint, RECRAWL_AGE,
+                       FETCH_LOG_FILENAME)
+from filter_planner import FilterPlanner, PLANNER_FILENAME
+from metrics import METRICS, MetricsReporter, call_timed
+from normalize import clean_text, join_clean, build_address
+from scraping_utils import (setup_logging, get_response, cache_response,
+                            uncache_response, close_session, close_cache,
+                            start_tor_pool, stop_tor_pool, get_tor_pool,
+                            BLOCK_DETECTOR, FATAL_ERROR_STR)
 
 TEMPLATE_SUBST = '[SUBDOMAIN]'
 BASE_URL_TEMPLATE = f'https://{TEMPLATE_SUBST}zoon.ru/'
 # SEARCH_URL = 'entertainment/type/batutnyj_tsentr/'
 SEARCH_URL = 'entertainment/'
+
+# Caption of the item parameter listing its categories
+CATEGORY_CAPTION = 'Развлечения'
 API_URL = '?action=listJson&type=service'
 
 SUBDOMAINS = {
@@ -72,12 +112,92 @@ PAGE_LIMIT = 8
 # Search filters are here
 FILTERS_FILENAME = 'filters.html'
 
+# JSON file with the crawl plan: categories to crawl in a single process
+# (see load_crawl_plan()). If None, only SEARCH_URL category is crawled.
+CRAWL_PLAN_FILENAME = None
+
+# Maximum count of categories crawled simultaneously
+PLAN_WORKERS = 4
+
+# Optional file with secondary filters in the same format (e.g. districts).
+# A filter hitting PAGE_LIMIT is walked again combined with each of them.
+SPLIT_FILTERS_FILENAME = None
+
+# Separates filters combined into a single filter string
+FILTER_SEPARATOR = ' '
+
+# Skipping filters without new items and walking the productive ones first
+# (see filter_planner module). Skipped filters are not walked at all until
+# their recheck age passes, so new items listed by them are found later.
+PLAN_FILTERS = False
+
 NL = '\r\n'
 
+# Number of worker threads for concurrent item fetching (1 - sequential mode)
+WORKERS = 4
+
+# Parsing item pages in a process pool, so parsing is not limited by the GIL
+USE_PARSE_PROCESSES = False
+
+# Number of parsing processes
+PARSE_PROCESSES = os.cpu_count()
+
+# Maximum count of fetched pages waiting for parsing (backpressure limit)
+MAX_PENDING_PAGES = 64
+
+# Refreshing stored items checked earlier than RECRAWL_AGE ago
+RECRAWL = False
+
+# Downloading item photos after scraping (see image_downloader module)
+DOWNLOAD_IMAGES = False
+
+# Routing requests through a pool of Tor instances (see tor_proxy module)
+USE_TOR_POOL = False
+
+# Number of filter walks run in parallel, walks for different subdomains
+# (cities) are preferred
+SUBDOMAIN_WORKERS = 1
+
+# Using asyncio crawl engine instead of threads (aiohttp is required)
+USE_ASYNC = False
+
+# Attempts to load a listing page before giving up the filter (it is left
+# incomplete in the frontier and resumed on the next run). After a failure the
+# filter walk is requeued, so other hosts are crawled during the cooldown.
+PAGE_RETRIES = 5
+
 CSV_DELIMITER = ','
 
+# Write buffer size for CSV export (bytes)
+CSV_BUFFER_SIZE = 1024 * 1024
+
 CSV_FILENAME = 'entertainment.csv'
 JSON_FILENAME = 'entertainment.json'
+STORE_FILENAME = 'entertainment.jsonl'
+
+# Exporting items to a columnar file along with CSV (pyarrow is required)
+EXPORT_PARQUET = False
+
+# Parquet file, or Arrow IPC file if the name ends with .arrow
+PARQUET_FILENAME = 'entertainment.parquet'
+
+# Compression codec of the columnar file
+PARQUET_COMPRESSION = 'zstd'
+
+# Items in a row group (record batch) of the columnar file
+PARQUET_BATCH_SIZE = 10000
+
+# File for persisting the index of fetched item URLs (None - not persisted)
+SEEN_FILENAME = None
+
+# Expected item count for keeping the URL index in a Bloom filter instead of
+# a set, for very large runs (None - exact set is used). Up to this count
+# about 0.1% of new items (url_index.BLOOM_ERROR_RATE) are skipped as false
+# positives, at twice the count the miss rate grows to about 6%.
+BLOOM_CAPACITY = None
+
+# File for the crawl progress, so an interrupted crawl can be resumed
+FRONTIER_FILENAME = 'frontier.sqlite'
 
 COLUMNS = [
     'Берется из URL',
@@ -95,17 +215,81 @@ COLUMNS = [
 
 SOCIAL_NETS_IND = COLUMNS.index('Время работы')
 
-def get_search_link(subdomain: str) -> str:
+SOCIAL_NETS_KEY = 'Соц. сети'
+
+# Columns holding lists joined with the separators, they are list columns in
+# the columnar export
+LIST_SEPARATORS = {
+    'Телефон': ', ',
+    'Фото': '; ',
+    'Категория': ', ',
+}
+
+# Column name -> index in Item.values
+COLUMN_INDEXES = {sys.intern(column): index
+                  for index, column in enumerate(COLUMNS)}
+
+class Item():
+    """Compact item record. Column values are kept in a tuple ordered as
+    COLUMNS, social network links are stored once in social_nets dict with
+    interned names.
+
+    Item supports read-only dict-like access (item[key], item.get(key)) with
+    the same keys as the dict produced by to_dict(), which is the format of
+    JSON files.
+    """
+    __slots__ = ('values', 'social_nets')
+
+    def __init__(self, values: tuple, social_nets: dict=None):
+        self.values = values
+        self.social_nets = social_nets or {}
+
+    @classmethod
+    def from_dict(cls, item: dict) -> 'Item':
+        social_nets = {sys.intern(name): link
+                       for name, link in item.get(SOCIAL_NETS_KEY,
+                                                  {}).items()}
+        return cls(tuple(item.get(column, '') for column in COLUMNS),
+                   social_nets)
+
+    def to_dict(self) -> dict:
+        item = dict(zip(COLUMNS, self.values))
+        item.update(self.social_nets)
+        item[SOCIAL_NETS_KEY] = dict(self.social_nets)
+        return item
+
+    def __getitem__(self, key: str):
+        index = COLUMN_INDEXES.get(key)
+        if index != None:
+            return self.values[index]
+        if key == SOCIAL_NETS_KEY:
+            return self.social_nets
+        return self.social_nets[key]
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __eq__(self, other) -> bool:
+        return (isinstance(other, Item) and self.values == other.values
+                and self.social_nets == other.social_nets)
+
+    def __repr__(self) -> str:
+        return f'Item({self.to_dict()!r})'
+
+def get_search_link(subdomain: str, search_url: str=SEARCH_URL) -> str:
     if subdomain == DEFAULT_SUBDOMAIN_NAME:
         link = (BASE_URL_TEMPLATE.replace(TEMPLATE_SUBST, '')
                 + DEFAULT_SUBDOMAIN_NAME + '/')
     else:
         link = BASE_URL_TEMPLATE.replace(TEMPLATE_SUBST, subdomain + '.')
 
-    return link + SEARCH_URL
+    return link + search_url
 
-def get_api_link(subdomain: str) -> str:
-    return get_search_link(subdomain) + API_URL
+def get_api_link(subdomain: str, search_url: str=SEARCH_URL) -> str:
+    return get_search_link(subdomain, search_url) + API_URL
 
 def get_search_links() -> list:
     return [get_search_link(subdomain) for subdomain in SUBDOMAINS]
@@ -117,71 +301,226 @@ def get_subdomain(url: str) -> dict:
     subdomain_str = urlparse(url).hostname.split('.')[0]
     return SUBDOMAINS.get(subdomain_str, DEFAULT_SUBDOMAIN)
 
-def clean_text(text: str) -> str:
-    return re.sub(r'\s+', ' ', text.strip())
+class Category():
+    """Crawl target: a zoon.ru category walked with its search filters for
+    the given subdomains (all SUBDOMAINS by default). Each category has its
+    own store, frontier, seen URLs index, CSV and Parquet files, so a venue
+    listed in several categories gets into each of them.
+    """
+    def __init__(self, name: str, search_url: str=None,
+                 caption: str=None, filters_filename: str=None,
+                 subdomains: list=None, store_filename: str=None,
+                 csv_filename: str=None, frontier_filename: str=None,
+                 json_filename: str=None, parquet_filename: str=None,
+                 seen_filename: str=None):
+        self.name = name
+        self.search_url = search_url or name + '/'
+        # Caption of the item parameter listing its categories
+        self.caption = caption
+        self.filters_filename = filters_filename or FILTERS_FILENAME
+        self.subdomains = subdomains
+        self.store_filename = store_filename or name + '.jsonl'
+        self.csv_filename = csv_filename or name + '.csv'
+        self.frontier_filename = (frontier_filename
+                                  or name + '_frontier.sqlite')
+        # Previous results in JSON format imported on the first run
+        self.json_filename = json_filename
+        self.parquet_filename = parquet_filename or name + '.parquet'
+        # The index is persisted only if SEEN_FILENAME is set
+        self.seen_filename = seen_filename
+        if seen_filename == None and SEEN_FILENAME != None:
+            self.seen_filename = name + '_seen.txt'
+
+    @classmethod
+    def from_dict(cls, category: dict, subdomains: list=None) -> 'Category':
+        return cls(category['name'], category.get('search_url'),
+                   category.get('caption'), category.get('filters'),
+                   category.get('subdomains', subdomains),
+                   category.get('store'), category.get('csv'),
+                   category.get('frontier'), category.get('json'),
+                   category.get('parquet'), category.get('seen'))
+
+    def get_api_links(self) -> list:
+        return [get_api_link(subdomain, self.search_url)
+                for subdomain in (self.subdomains or SUBDOMAINS)]
+
+# Category given by the module settings
+def get_default_category() -> Category:
+    return Category(SEARCH_URL.split('/')[0], SEARCH_URL, CATEGORY_CAPTION,
+                    FILTERS_FILENAME, store_filename=STORE_FILENAME,
+                    csv_filename=CSV_FILENAME,
+                    frontier_filename=FRONTIER_FILENAME,
+                    json_filename=JSON_FILENAME,
+                    parquet_filename=PARQUET_FILENAME,
+                    seen_filename=SEEN_FILENAME)
+
+def load_crawl_plan(filename: str) -> list:
+    """Returns the list of categories from JSON file as follows:
+    {
+        "subdomains": ["msk", "spb"],
+        "categories": [
+            {"name": "entertainment", "caption": "Развлечения"},
+            {"name": "beauty", "caption": "Услуги", "filters": "beauty.html",
+             "subdomains": ["msk"], "csv": "beauty_msk.csv"}
+        ]
+    }
+    Only the category name is required. Optional keys are "search_url",
+    "caption", "filters", "subdomains" (all SUBDOMAINS by default), "store",
+    "csv", "frontier", "json", "parquet" and "seen". Returns None on
+    failure.
+    """
+    try:
+        with open(filename, encoding='utf-8') as f:
+            plan = json.load(f)
+        return [Category.from_dict(category, plan.get('subdomains'))
+                for category in plan['categories']]
+    except OSError:
+        logging.error(f"Can't load the file {filename}.")
+    except (ValueError, KeyError, TypeError) as e:
+        logging.error(f'Invalid crawl plan {filename}: {e!r}')
 
-def get_item_param_data(soup: BeautifulSoup, param_caption: str) -> Tag:
+    return None
+
+# Builds caption -> <dd> tag index for all item parameters in a single pass
+def get_item_params(soup: BeautifulSoup) -> dict:
+    params = {}
     for caption in soup.find_all('dt'):
-        if clean_text(caption.get_text()) == param_caption:
-            return caption.find_next_sibling('dd')
+        params.setdefault(clean_text(caption.get_text()),
+                          caption.find_next_sibling('dd'))
 
-    return None
+    return params
 
-def get_item_links(url: str=None, html: str=None) -> list:
-    if html == None:
-        response = get_response(url)
-        if response == None:
-            return None
-        html = response.text
+def get_item_links(url: str=None, html: str=None,
+                   soup: BeautifulSoup=None) -> list:
+    if soup == None:
+        if html == None:
+            response = get_response(url)
+            if response == None:
+                return None
+            html = response.text
+        soup = BeautifulSoup(html, HTML_PARSER)
 
-    soup = BeautifulSoup(html, 'html.parser')
     item_links = []
     for item_div in soup.find_all('div', class_='service-description'):
         item_links.append(item_div.find('a', class_='js-item-url')['href'])
 
     return item_links
 
-def is_last_page(html: str) -> list:
-    soup = BeautifulSoup(html, 'html.parser')
+def is_last_page(html: str=None, soup: BeautifulSoup=None) -> bool:
+    if soup == None:
+        soup = BeautifulSoup(html, HTML_PARSER)
     if soup.find('span', text='Показать еще'):
         return False
 
     return True
 
+# Parses listing HTML once, returns (item links, last page flag) tuple
+@METRICS.timed('parse_seconds', page='listing')
+def parse_listing(html: str) -> tuple:
+    soup = BeautifulSoup(html, HTML_PARSER)
+    return get_item_links(soup=soup), is_last_page(soup=soup)
+
 def load_filters(filename: str=FILTERS_FILENAME) -> list:
     with open(filename, 'rt', encoding='utf-8') as f:
         soup = BeautifulSoup(f, 'html.parser')
         return [checkbox['name'] for checkbox in soup.find_all('input')]
 
-def get_ajax_html(api_url: str, item_filter: str, page: int) -> str:
+# Item filter may contain several filters joined with FILTER_SEPARATOR
+def get_ajax_params(item_filter: str, page: int) -> dict:
     params = {
         'need[]': 'items',
         'search_query_form': 1,
         'page': page,
-        # Filter example: 'm[5a7bf6f2c1098a2bef1ecea6]'
-        item_filter: 1,
     }
-    r = get_response(api_url, params=params, post=True)
+    # Filter example: 'm[5a7bf6f2c1098a2bef1ecea6]'
+    for name in item_filter.split(FILTER_SEPARATOR):
+        params[name] = 1
 
-    if not r:
-        return None
+    return params
+
+# Registers a failure of the given kind. The blocked Tor circuit is paused if
+# the request was made via proxy, otherwise the host.
+def register_block(kind: str, url: str, proxy=None):
+    BLOCK_DETECTOR.record(kind, url, pause_host=proxy == None)
 
+    tor_pool = get_tor_pool()
+    if kind == CAPTCHA and proxy != None and tor_pool != None:
+        tor_pool.report_blocked(proxy)
+
+# Registers a failed API response as CAPTCHA or JSON error
+def register_ajax_failure(text: str, url: str, proxy=None):
+    register_block(CAPTCHA if is_captcha(text) else JSON_ERROR, url, proxy)
+
+# Extracts listing HTML from API response text
+def extract_ajax_html(text: str, url: str, proxy=None) -> str:
     try:
-        json = r.json()
+        data = json.loads(text)
     except Exception as e:
         logging.error('Failure while getting JSON: ' + str(e))
+        register_ajax_failure(text, url, proxy)
         return None
 
-    if json.get('html') == None:
+    if not isinstance(data, dict) or data.get('html') == None:
         logging.error('API request via POST was not successful.')
+        register_ajax_failure(text, url, proxy)
+        return None
+
+    return data['html']
+
+# Extracts listing HTML from API response, only valid responses are kept in
+# the cache
+def get_response_html(r: requests.Response, api_url: str) -> str:
+    html = extract_ajax_html(r.text, api_url, getattr(r, 'tor_proxy', None))
+    if html == None:
+        uncache_response(r)
+    else:
+        cache_response(r)
+    return html
+
+def get_ajax_html(api_url: str, item_filter: str, page: int) -> str:
+    r = get_response(api_url, params=get_ajax_params(item_filter, page),
+                     post=True)
+
+    if not r:
         return None
 
-    return json['html']
+    return get_response_html(r, api_url)
+
+# Caches the item page once it has been parsed and records its fingerprint
+# in the fetch log (if given). The page which can't be parsed is dropped from
+# the cache and checked for CAPTCHA.
+def register_item_page(url: str, response: requests.Response, item: Item,
+                       fetch_log: FetchLog=None):
+    if item != None:
+        cache_response(response)
+        if fetch_log != None:
+            fetch_log.record_response(url, response, item.to_dict())
+        return
+
+    uncache_response(response)
+    if is_captcha(response.text):
+        logging.warning(f'CAPTCHA instead of item page {url}.')
+        register_block(CAPTCHA, url, getattr(response, 'tor_proxy', None))
+
+def scrape_item(url: str) -> Item:
+    """Scrapes single item with given URL. The output is the same as for
+    parse_item() function.
+    """
+    response = get_response(url)
+    if response == None:
+        return None
+
+    item = parse_item(url, response.text)
+    register_item_page(url, response, item)
+    return item
 
-def scrape_item(url: str) -> dict:
-    """Scrapes single item with given URL.
+@METRICS.timed('parse_seconds', page='item')
+def parse_item(url: str, html: str,
+               category_caption: str=CATEGORY_CAPTION) -> Item:
+    """Extracts single item data from its page HTML. Item categories are
+    taken from the parameter with category_caption.
 
-    Returns a dict as follows:
+    Returns an Item, its to_dict() method gives a dict as follows:
     {
         'Берется из URL': str,
         'Регион России': str,
@@ -207,42 +546,32 @@ def scrape_item(url: str) -> dict:
     item['Регион России'] = subdomain['region']
     item['Город'] = subdomain['city']
 
-    response = get_response(url)
-    if response == None:
-        return None
-
     try:
-        soup = BeautifulSoup(response.text, 'html.parser')
+        soup = BeautifulSoup(html, HTML_PARSER)
+        params = get_item_params(soup)
 
         address_tag = soup.find('address', class_='iblock')
-        item['Адрес'] = clean_text(address_tag.get_text())
         # Address extension
         address_ext = address_tag.find_next_sibling('div')
         if address_ext:
-            item['Адрес'] += NL + clean_text(address_ext.get_text())
-        # Metros
-        metros = soup.find_all('div', class_='address-metro')
-        if metros:
-            item['Адрес'] += NL + 'Метро: '
-            for metro in metros:
-                item['Адрес'] += clean_text(metro.get_text()) + ' '
-            item['Адрес'] = item['Адрес'].strip() # Remove last \n character
+            address_ext = clean_text(address_ext.get_text())
+        metros = [clean_text(metro.get_text())
+                  for metro in soup.find_all('div', class_='address-metro')]
+        item['Адрес'] = build_address(clean_text(address_tag.get_text()),
+                                      address_ext, metros)
 
         item['Название'] = clean_text(soup.find('h1').get_text())
 
-        description_lines = []
-        for paragraph in get_item_param_data(soup, 'Описание').find_all('p'):
-            paragraph = clean_text(paragraph.get_text())
-            if paragraph:
-                description_lines.append(paragraph)
-        item['Описание'] = NL.join(description_lines)
+        item['Описание'] = join_clean(
+            (paragraph.get_text()
+             for paragraph in params['Описание'].find_all('p')), NL)
 
         phone_list = soup.find('div', class_='service-phones-list')
         if phone_list:
-            phones = [clean_text(phone['data-number'])
-                      for phone in phone_list.find_all('span',
-                                                       class_='js-phone')]
-            item['Телефон'] = ', '.join(phones)
+            item['Телефон'] = join_clean(
+                (phone['data-number']
+                 for phone in phone_list.find_all('span', class_='js-phone')),
+                ', ', skip_empty=False)
         else:
             item['Телефон'] = ''
 
@@ -255,32 +584,26 @@ def scrape_item(url: str) -> dict:
 
         item['Полный URL без параметров'] = url
 
-        category_cell = get_item_param_data(soup, 'Развлечения')
+        category_cell = params.get(category_caption)
         if category_cell:
-            category_links = category_cell.find_all('a')
-            categories = [clean_text(category_link.get_text())
-                          for category_link in category_links]
-            item['Категория'] = ', '.join(categories)
+            item['Категория'] = join_clean(
+                (category_link.get_text()
+                 for category_link in category_cell.find_all('a')),
+                ', ', skip_empty=False)
         else:
             item['Категория'] = ''
 
-        open_time_cell = get_item_param_data(soup, 'Время работы')
+        open_time_cell = params.get('Время работы')
         if open_time_cell:
-            open_time_lines = []
-            for tag in open_time_cell.div.children:
-                if isinstance(tag, NavigableString):
-                    text = str(tag)
-                else:
-                    text = tag.get_text()
-                open_time_line = clean_text(text)
-                if open_time_line:
-                    open_time_lines.append(open_time_line)
-            item['Время работы'] = '; '.join(open_time_lines)
+            item['Время работы'] = join_clean(
+                (str(tag) if isinstance(tag, NavigableString)
+                 else tag.get_text()
+                 for tag in open_time_cell.div.children), '; ')
         else:
             item['Время работы'] = ''
 
         item['Соц. сети'] = {}
-        social_nets = get_item_param_data(soup, 'Страница в соцсетях')
+        social_nets = params.get('Страница в соцсетях')
         if social_nets:
             for social_net in social_nets.div.find_all('a'):
                 social_net_name = clean_text(social_net.get_text())
@@ -294,100 +617,817 @@ def scrape_item(url: str) -> dict:
         logging.error(f'Failure while scraping item {url}: ' + str(e))
         return None
 
-    return item
+    return Item.from_dict(item)
 
-def get_all_social_nets(items: list) -> list:
-    social_nets = []
+# items may be any iterable (e.g. a list or ItemStore)
+def get_all_social_nets(items) -> list:
+    social_nets = {}
     for item in items:
-        for social_net in item['Соц. сети']:
-            if social_net not in social_nets:
-                social_nets.append(social_net)
+        social_nets.update(dict.fromkeys(item.get('Соц. сети', ())))
 
-    return social_nets
+    return list(social_nets)
 
-# Changes global variable COLUMNS and updates items
-def social_nets_fix(social_nets: list, items: list = []):
-    # Inserts social_nets list into COLUMNS list at SOCIAL_NETS_IND position
-    COLUMNS[SOCIAL_NETS_IND:SOCIAL_NETS_IND] = social_nets
+# Returns CSV columns with dynamic social network columns inserted
+# at SOCIAL_NETS_IND position
+def get_columns(social_nets: list) -> list:
+    return COLUMNS[:SOCIAL_NETS_IND] + social_nets + COLUMNS[SOCIAL_NETS_IND:]
 
-    # Fixing each item dictionary
-    for index, item in enumerate(items):
-        del items[index]['Соц. сети']
-        for social_net in social_nets:
-            if items[index].get(social_net) == None:
-                items[index][social_net] = ''
+def get_item_url(item) -> str:
+    return item['Полный URL без параметров']
 
 def get_item_urls(items: list) -> list:
-    return [item['Полный URL без параметров'] for item in items]
+    return [get_item_url(item) for item in items]
+
+def item_sort_key(item: dict) -> tuple:
+    return item['Город'], item['Название']
 
 def items_sort(items: list):
-    items.sort(key=lambda item: (item['Город'], item['Название']))
-
-# items parameter may contain previous scraping result
-def scrape_items(items: list=[]) -> list:
-    item_urls = get_item_urls(items)
-    item_filters = load_filters()
-    for subdomain_api_link in get_api_links():
-        logging.info(f'>>>Starting scraping for {subdomain_api_link}<<<')
-        for item_filter in item_filters:
-            logging.info(f'>>>Starting scraping for filter "{item_filter}"<<<')
-            page = 1
-            modified = False
-            while page <= PAGE_LIMIT:
-                logging.info(f'>>>Starting scraping for page {page}<<<')
-                html = get_ajax_html(api_url=subdomain_api_link,
-                                     item_filter=item_filter,
-                                     page=page)
-
-                # Possible anti-scraping protection activated
-                if html == None:
-                    logging.info('Access fail. '
-                                 'Maybe CAPTCHA solving is needed.')
-                    input('Press ENTER when CAPTCHA is solved.')
-                    continue
+    items.sort(key=item_sort_key)
 
-                item_links = get_item_links(html=html)
-                if item_links == None:
+# Sorts an item stream with bounded memory, the ordering is the same as for
+# items_sort() function
+def sort_items(items) -> SortedItems:
+    return SortedItems(items, key=item_sort_key,
+                       item_factory=Item.from_dict)
+
+class ScrapePipeline():
+    """Fetches item pages with a pool of worker threads. If parse_processes
+    is given, raw HTML is passed to a process pool running parse_item() and
+    parse_listing(), otherwise pages are parsed by the fetching threads.
+
+    At most max_pending pages wait for parsing at any moment: fetchers block
+    until parsers catch up, so memory consumption stays bounded.
+    """
+    def __init__(self, workers: int=WORKERS, parse_processes: int=None,
+                 max_pending: int=MAX_PENDING_PAGES,
+                 fetch_log: FetchLog=None):
+        self.fetch_log = fetch_log
+        self.fetchers = ThreadPoolExecutor(max_workers=workers)
+        self.parsers = None
+        if parse_processes:
+            self.parsers = ProcessPoolExecutor(max_workers=parse_processes)
+        self.pending = threading.BoundedSemaphore(max_pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.fetchers.shutdown()
+        if self.parsers != None:
+            self.parsers.shutdown()
+
+    # Returns the future of the function result. The parsing time measured
+    # by the worker process is observed here, as the metrics of the workers
+    # are not collected.
+    def _parse(self, function, *args) -> Future:
+        self.pending.acquire()
+        try:
+            timed_future = self.parsers.submit(call_timed, function, *args)
+        except Exception:
+            self.pending.release()
+            raise
+
+        future = Future()
+        def set_result(timed_future: Future):
+            self.pending.release()
+            try:
+                result, seconds = timed_future.result()
+            except BaseException as e:
+                future.set_exception(e)
+                return
+            METRICS.observe_timed(function, seconds)
+            future.set_result(result)
+
+        timed_future.add_done_callback(set_result)
+        return future
+
+    def _fetch_item(self, url: str, category_caption: str):
+        BLOCK_DETECTOR.wait_host(url)
+        response = get_response(url)
+        if response == None:
+            return None
+        if self.parsers == None:
+            item = parse_item(url, response.text, category_caption)
+            register_item_page(url, response, item, self.fetch_log)
+            return item
+
+        future = self._parse(parse_item, url, response.text,
+                             category_caption)
+        future.add_done_callback(lambda future: register_item_page(
+            url, response, None if future.exception() else future.result(),
+            self.fetch_log))
+        return future
+
+    @staticmethod
+    def _get_result(result):
+        if not isinstance(result, Future):
+            return result
+        try:
+            return result.result()
+        except BrokenProcessPool as e:
+            logging.error('Parsing process failure: ' + str(e))
+            return None
+
+    def parse_listing(self, html: str) -> tuple:
+        if self.parsers == None:
+            return parse_listing(html)
+
+        return self._parse(parse_listing, html).result()
+
+    # Scrapes items for given URLs concurrently.
+    # Returns the list of (url, item) tuples, item is None on failure.
+    def scrape_links(self, item_links: list,
+                     category_caption: str=CATEGORY_CAPTION) -> list:
+        for item_link in item_links:
+            logging.info(f'Scraping item {item_link}')
+
+        results = list(self.fetchers.map(
+            lambda url: self._fetch_item(url, category_caption), item_links))
+        return [(item_link, self._get_result(result))
+                for item_link, result in zip(item_links, results)]
+
+# Logs new and duplicate item counts for each filter
+def log_filter_stats(filter_stats: dict):
+    logging.info('Filter statistics (new items / duplicates):')
+    for item_filter, (new_count, duplicate_count) in sorted(
+            filter_stats.items(), key=lambda pair: pair[1]):
+        logging.info(f'{item_filter}: {new_count} / {duplicate_count}')
+
+class FilterWalk():
+    """Progress of walking the filter listing pages for the API link, so the
+    walk interrupted by access failures may be continued later.
+    """
+    __slots__ = ('api_link', 'item_filter', 'page', 'pages', 'new_count',
+                 'walk_new_count', 'duplicate_count', 'last_page',
+                 'failures', 'not_before')
+
+    def __init__(self, api_link: str, item_filter: str):
+        self.api_link = api_link
+        self.item_filter = item_filter
+        # The next page to load, None until the walk is started
+        self.page = None
+        # Pages and new items of the whole walk, including the pages
+        # completed before the crawl was resumed
+        self.pages = 0
+        self.walk_new_count = 0
+        # New items and duplicates found in this run
+        self.new_count = 0
+        self.duplicate_count = 0
+        self.last_page = False
+        # Consecutive failures to load a listing page
+        self.failures = 0
+        # Monotonic time before which the walk is not continued
+        self.not_before = 0
+
+class Crawler():
+    """Walks listing pages for all the subdomains and filters, scrapes new
+    items and adds them to the items list and the store (if given).
+
+    Filter walks of all the subdomains are run by subdomain_workers threads
+    in parallel, each with its own share of item fetching workers; requests
+    to every host are limited by the rate limiter separately. A walk failing
+    to load a listing page (e.g. the host is paused after CAPTCHA) is
+    requeued and the thread goes on with walks for other hosts. If frontier
+    is given, the crawl continues from the point it was stopped at: on
+    SIGINT (or a failure) the walks stop between listing pages. The category
+    given by the module settings is crawled by default.
+    """
+    def __init__(self, items: list, store: ItemStore=None,
+                 seen: SeenIndex=None, frontier: CrawlFrontier=None,
+                 subdomain_workers: int=SUBDOMAIN_WORKERS,
+                 fetch_log: FetchLog=None, planner: FilterPlanner=None,
+                 category: Category=None):
+        self.items = items
+        self.category = category or get_default_category()
+        self.fetch_log = fetch_log
+        self.store = store
+        self.seen = seen
+        self.frontier = frontier
+        self.planner = planner
+        self.subdomain_workers = subdomain_workers
+        self.item_filters = load_filters(self.category.filters_filename)
+        self.split_filters = []
+        if SPLIT_FILTERS_FILENAME != None:
+            self.split_filters = load_filters(SPLIT_FILTERS_FILENAME)
+        # Filter -> [new item count, duplicate count]
+        self.filter_stats = {}
+        # Count of filters skipped due to access failures
+        self.skipped_filters = 0
+        self.lock = threading.Lock()
+        self.pipeline = None
+        # Filter walks waiting to be run
+        self.walks = []
+        # API link -> count of walks being run
+        self.active_links = {}
+        self.walk_count = 0
+        self.walks_done = 0
+        self.condition = threading.Condition()
+        # Set on interruption, the walks stop between listing pages and
+        # are resumed by the next run
+        self.stopped = threading.Event()
+
+    # Adds scraped items from (url, item) tuples.
+    # Returns the count of new items.
+    def add_items(self, results: list) -> int:
+        new_count = 0
+        for item_link, new_item in results:
+            # Error while item scraping
+            if new_item == None:
+                continue
+
+            if self.frontier != None:
+                self.frontier.remove_pending([item_link])
+            if not self.seen.add(item_link):
+                continue
+            new_count += 1
+            self.items.append(new_item)
+            if self.store != None:
+                self.store.append(new_item)
+
+        return new_count
+
+    def update_stats(self, item_filter: str, new_count: int,
+                     duplicate_count: int) -> list:
+        METRICS.inc('items', new_count, result='new')
+        METRICS.inc('items', duplicate_count, result='duplicate')
+        with self.lock:
+            stats = self.filter_stats.setdefault(item_filter, [0, 0])
+            stats[0] += new_count
+            stats[1] += duplicate_count
+            return list(stats)
+
+    # The filter is left incomplete in the frontier to be resumed later
+    def skip_filter(self, api_link: str, item_filter: str, page: int,
+                    prefix: str):
+        logging.error(f'{prefix} Access fail for filter "{item_filter}", '
+                      f'page {page}. Skipping the filter.')
+        with self.lock:
+            self.skipped_filters += 1
+
+    # Returns the filters to walk for the API link
+    def plan_filters(self, api_link: str, item_filters: list) -> list:
+        if self.frontier != None:
+            item_filters = [
+                item_filter for item_filter in item_filters
+                if not self.frontier.is_filter_done(api_link, item_filter)]
+        if self.planner == None:
+            return list(item_filters)
+
+        planned = self.planner.plan(api_link, item_filters)
+        if len(planned) < len(item_filters):
+            prefix = f'[{get_subdomain(api_link)["name"]}]'
+            logging.info(f'{prefix} {len(item_filters) - len(planned)} '
+                         'filters without new items skipped.')
+        return planned
+
+    # Finer filters for the filter which has hit the page limit
+    def get_split_filters(self, item_filter: str) -> list:
+        if FILTER_SEPARATOR in item_filter:
+            return []
+        return [item_filter + FILTER_SEPARATOR + split_filter
+                for split_filter in self.split_filters]
+
+    # Registers the complete filter walk
+    def finish_filter(self, api_link: str, item_filter: str, pages: int,
+                      new_count: int, saturated: bool):
+        METRICS.inc('listing_pages', pages)
+        if self.frontier != None:
+            self.frontier.mark_filter_done(api_link, item_filter)
+        if self.planner != None:
+            self.planner.record(api_link, item_filter, pages, new_count,
+                                saturated)
+        if saturated:
+            METRICS.inc('saturated_filters')
+            logging.warning(f'Filter "{item_filter}" hit the page limit, '
+                            'some items may be missed.')
+
+    def scrape_pending(self):
+        pending = self.frontier.get_pending()
+        if pending:
+            logging.info(f'Scraping {len(pending)} pending items.')
+            self.add_items(self.pipeline.scrape_links(
+                pending, self.category.caption))
+            # Failed items are not retried endlessly
+            self.frontier.remove_pending(pending)
+
+    # Creates walks of the filters planned for the API link
+    def add_walks(self, api_link: str, item_filters: list):
+        walks = [FilterWalk(api_link, item_filter)
+                 for item_filter in self.plan_filters(api_link, item_filters)]
+        with self.condition:
+            self.walks += walks
+            self.walk_count += len(walks)
+            self.condition.notify_all()
+
+    def get_walk(self) -> 'FilterWalk':
+        """Returns the next walk whose host is not paused, preferring API
+        links which are not being walked by other threads. If all the hosts
+        are paused, waits for the nearest cooldown expiration. Returns None
+        when all the walks are complete.
+        """
+        with self.condition:
+            while True:
+                if self.stopped.is_set():
+                    return None
+                if not self.walks and not self.active_links:
                     return None
-                logging.info(f'Item count on page: {len(item_links)}.')
-                for item_link in item_links:
-                    if item_link in item_urls:
-                        logging.info(f'Item {item_link} already fetched.')
-                        continue
-
-                    logging.info(f'Scraping item {item_link}')
-                    new_item = scrape_item(item_link)
-                    # Error while item scraping
-                    if new_item == None:
-                        continue
-
-                    item_urls.append(item_link)
-                    items.append(new_item)
-                    modified = True
-
-                # Definitely the last page
-                if len(item_links) < ITEMS_PER_PAGE or is_last_page(html=html):
-                    break
-
-                page += 1
-
-            if modified:
-                # Saving intermediate scraping results for each search filter
-                logging.info(f'Saving scraping results.')
-                save_items_json(items, JSON_FILENAME)
-                modified = False
 
-    return items
+                now = time.monotonic()
+                ready = []
+                delay = None
+                for walk in self.walks:
+                    wait = max(BLOCK_DETECTOR.get_cooldown(walk.api_link),
+                               walk.not_before - now)
+                    if wait <= 0:
+                        ready.append(walk)
+                    elif delay == None or wait < delay:
+                        delay = wait
+
+                if ready:
+                    walk = min(ready, key=lambda walk: self.active_links.get(
+                        walk.api_link, 0))
+                    self.walks.remove(walk)
+                    self.active_links[walk.api_link] = (
+                        self.active_links.get(walk.api_link, 0) + 1)
+                    return walk
+
+                # Running walks may add split filters
+                self.condition.wait(delay)
+
+    # Stops the walks being run by other threads (e.g. on SIGINT)
+    def stop(self):
+        with self.condition:
+            self.stopped.set()
+            self.condition.notify_all()
+
+    def release_walk(self, walk: 'FilterWalk', requeue: bool=False):
+        with self.condition:
+            self.active_links[walk.api_link] -= 1
+            if not self.active_links[walk.api_link]:
+                del self.active_links[walk.api_link]
+            if requeue:
+                self.walks.append(walk)
+            else:
+                self.walks_done += 1
+            self.condition.notify_all()
+
+    # Continues the filter walk. Returns False if a listing page can't be
+    # loaded, then the walk should be continued later.
+    def scrape_filter(self, walk: 'FilterWalk', prefix: str) -> bool:
+        api_link = walk.api_link
+        item_filter = walk.item_filter
+        if walk.page == None:
+            walk.page = 1
+            if self.frontier != None:
+                walk.pages, walk.walk_new_count, walk.last_page = (
+                    self.frontier.get_progress(api_link, item_filter))
+                walk.page = self.frontier.get_next_page(api_link,
+                                                        item_filter)
+
+        while walk.page <= PAGE_LIMIT and not walk.last_page:
+            if self.stopped.is_set():
+                return False
+            page = walk.page
+            logging.info(f'{prefix} >>>Starting scraping for page {page}<<<')
+            html = get_ajax_html(api_url=api_link, item_filter=item_filter,
+                                 page=page)
+            # Possible anti-scraping protection activated
+            if html == None:
+                return False
+            walk.failures = 0
+            walk.pages += 1
+
+            item_links, last_page = self.pipeline.parse_listing(html)
+            # Definitely the last page
+            walk.last_page = last_page or len(item_links) < ITEMS_PER_PAGE
+            logging.info(f'{prefix} Item count on page: {len(item_links)}.')
+
+            new_links = []
+            for item_link in item_links:
+                if item_link in self.seen or item_link in new_links:
+                    logging.info(f'Item {item_link} already fetched.')
+                    walk.duplicate_count += 1
+                    continue
+                new_links.append(item_link)
+
+            if self.frontier != None:
+                self.frontier.add_pending(new_links)
+            page_new_count = self.add_items(self.pipeline.scrape_links(
+                new_links, self.category.caption))
+            walk.new_count += page_new_count
+            walk.walk_new_count += page_new_count
+            if self.frontier != None:
+                self.frontier.mark_page_done(api_link, item_filter, page,
+                                             page_new_count, walk.last_page)
+            walk.page += 1
+
+        self.finish_filter(api_link, item_filter, walk.pages,
+                           walk.walk_new_count, not walk.last_page)
+        return True
+
+    # Runs filter walks until all of them are complete
+    def work(self):
+        while True:
+            walk = self.get_walk()
+            if walk == None:
+                return
+
+            prefix = f'[{get_subdomain(walk.api_link)["name"]}]'
+            logging.info(f'{prefix} >>>Starting scraping for filter '
+                         f'"{walk.item_filter}"<<<')
+            try:
+                complete = self.scrape_filter(walk, prefix)
+            except BaseException:
+                self.release_walk(walk)
+                raise
+
+            # The walk is left incomplete in the frontier
+            if self.stopped.is_set():
+                self.release_walk(walk, requeue=True)
+                return
+
+            if not complete:
+                walk.failures += 1
+                if walk.failures < PAGE_RETRIES:
+                    # The walk is continued after the host cooldown, other
+                    # hosts are crawled meanwhile
+                    cooldown = BLOCK_DETECTOR.get_cooldown(walk.api_link)
+                    if not cooldown:
+                        walk.not_before = (time.monotonic()
+                                           + backoff_delay(walk.failures))
+                    logging.info(f'{prefix} Access fail for filter '
+                                 f'"{walk.item_filter}", it is requeued.')
+                    self.release_walk(walk, requeue=True)
+                    continue
+                self.skip_filter(walk.api_link, walk.item_filter, walk.page,
+                                 prefix)
+            elif not walk.last_page:
+                self.add_walks(walk.api_link,
+                               self.get_split_filters(walk.item_filter))
+
+            stats = self.update_stats(walk.item_filter, walk.new_count,
+                                      walk.duplicate_count)
+            self.release_walk(walk)
+            logging.info(f'{prefix} Filter "{walk.item_filter}": {stats[0]} '
+                         f'new items, {stats[1]} duplicates so far.')
+            logging.info(f'Progress: filter {self.walks_done} of '
+                         f'{self.walk_count}, {len(self.items)} items.')
+
+    # The pipeline may be shared by several crawlers
+    def run(self, pipeline: ScrapePipeline=None) -> list:
+        if pipeline == None:
+            parse_processes = PARSE_PROCESSES if USE_PARSE_PROCESSES else None
+            with ScrapePipeline(workers=WORKERS * self.subdomain_workers,
+                                parse_processes=parse_processes,
+                                fetch_log=self.fetch_log) as pipeline:
+                return self.run(pipeline)
+
+        self.pipeline = pipeline
+        if self.frontier != None:
+            self.scrape_pending()
+
+        for api_link in self.category.get_api_links():
+            self.add_walks(api_link, self.item_filters)
+        # On SIGINT (or any failure) the pool shutdown waits only for the
+        # listing pages being scraped
+        with ThreadPoolExecutor(
+                max_workers=self.subdomain_workers) as executor:
+            try:
+                for future in [executor.submit(self.work)
+                               for _ in range(self.subdomain_workers)]:
+                    future.result()
+            except BaseException:
+                self.stop()
+                raise
+
+        self.pipeline = None
+        return self.finish()
+
+    def finish(self) -> list:
+        if self.skipped_filters:
+            logging.warning(f'{self.skipped_filters} filters skipped due to '
+                            'access failures, run again to resume them.')
+        elif self.frontier != None:
+            # The crawl is complete, the next one starts from scratch
+            self.frontier.reset()
+        log_filter_stats(self.filter_stats)
+        BLOCK_DETECTOR.log_stats()
+        return self.items
+
+class AsyncCrawler(Crawler):
+    """Asyncio crawl engine. All the subdomains and filters are walked
+    simultaneously on a single thread, item pages are fetched as soon as
+    they are found. If parse_processes is given, pages are parsed in a process
+    pool, otherwise on the event loop thread. Store, frontier and fetch log
+    writes are run in the default executor, so disk syncs do not stall the
+    event loop.
+    """
+    def __init__(self, items: list, store: ItemStore=None,
+                 seen: SeenIndex=None, frontier: CrawlFrontier=None,
+                 parse_processes: int=None, fetch_log: FetchLog=None,
+                 planner: FilterPlanner=None, category: Category=None):
+        super().__init__(items, store, seen, frontier, fetch_log=fetch_log,
+                         planner=planner, category=category)
+        self.parse_processes = parse_processes
+        self.parsers = None
+        self.fetcher = None
+        # Item URLs being fetched at the moment
+        self.in_flight = set()
+
+    async def parse(self, function, *args):
+        if self.parsers == None:
+            return function(*args)
+
+        loop = asyncio.get_running_loop()
+        result, seconds = await loop.run_in_executor(self.parsers,
+                                                     call_timed, function,
+                                                     *args)
+        METRICS.observe_timed(function, seconds)
+        return result
+
+    async def scrape_item(self, url: str) -> tuple:
+        logging.info(f'Scraping item {url}')
+        cooldown = BLOCK_DETECTOR.get_cooldown(url)
+        if cooldown:
+            await asyncio.sleep(cooldown)
+        response = await self.fetcher.get_response(url)
+        if response == None:
+            return url, None
+
+        item = await self.parse(parse_item, url, response.text,
+                                self.category.caption)
+        await run_blocking(register_item_page, url, response, item,
+                           self.fetch_log)
+        return url, item
+
+    # Scrapes the items and adds them, returns the count of new items. The
+    # links stay in flight until the items are added to the seen index.
+    async def scrape_links(self, item_links: list) -> int:
+        self.in_flight.update(item_links)
+        try:
+            results = await asyncio.gather(*[self.scrape_item(item_link)
+                                             for item_link in item_links])
+            return await run_blocking(self.add_items, results)
+        finally:
+            self.in_flight.difference_update(item_links)
+
+    async def get_ajax_html(self, api_link: str, item_filter: str,
+                            page: int) -> str:
+        for attempt in range(0, PAGE_RETRIES):
+            if attempt > 0:
+                await asyncio.sleep(BLOCK_DETECTOR.get_cooldown(api_link)
+                                    or backoff_delay(attempt))
+            r = await self.fetcher.get_response(
+                api_link, params=get_ajax_params(item_filter, page),
+                post=True)
+            if r != None:
+                html = await run_blocking(get_response_html, r, api_link)
+                if html != None:
+                    return html
+
+        return None
+
+    async def scrape_filter(self, api_link: str, item_filter: str,
+                            prefix: str) -> tuple:
+        new_count = duplicate_count = 0
+        # Pages and new items of the whole walk, including the pages
+        # completed before the crawl was resumed
+        pages = walk_new_count = 0
+        page = 1
+        last_page = False
+        if self.frontier != None:
+            pages, walk_new_count, last_page = await run_blocking(
+                self.frontier.get_progress, api_link, item_filter)
+            page = await run_blocking(self.frontier.get_next_page,
+                                      api_link, item_filter)
+        while page <= PAGE_LIMIT and not last_page:
+            html = await self.get_ajax_html(api_link, item_filter, page)
+            # Possible anti-scraping protection activated
+            if html == None:
+                self.skip_filter(api_link, item_filter, page, prefix)
+                return new_count, duplicate_count, False
+            pages += 1
+
+            item_links, last_page = await self.parse(parse_listing, html)
+            # Definitely the last page
+            last_page = last_page or len(item_links) < ITEMS_PER_PAGE
+
+            new_links = []
+            for item_link in item_links:
+                if (item_link in self.seen or item_link in self.in_flight
+                        or item_link in new_links):
+                    duplicate_count += 1
+                    continue
+                new_links.append(item_link)
+
+            if self.frontier != None:
+                await run_blocking(self.frontier.add_pending, new_links)
+            page_new_count = await self.scrape_links(new_links)
+            new_count += page_new_count
+            walk_new_count += page_new_count
+            if self.frontier != None:
+                await run_blocking(self.frontier.mark_page_done,
+                                   api_link, item_filter, page,
+                                   page_new_count, last_page)
+            page += 1
+
+        saturated = not last_page
+        await run_blocking(self.finish_filter, api_link, item_filter,
+                           pages, walk_new_count, saturated)
+        return new_count, duplicate_count, saturated
+
+    async def scrape_filter_task(self, api_link: str, item_filter: str):
+        prefix = f'[{get_subdomain(api_link)["name"]}]'
+        new_count, duplicate_count, saturated = await self.scrape_filter(
+            api_link, item_filter, prefix)
+        stats = self.update_stats(item_filter, new_count, duplicate_count)
+        logging.info(f'{prefix} Filter "{item_filter}" complete: {new_count} '
+                     f'new items ({stats[0]} new items, {stats[1]} '
+                     'duplicates in all subdomains so far).')
+
+        if saturated:
+            split_filters = await run_blocking(
+                self.plan_filters, api_link,
+                self.get_split_filters(item_filter))
+            await asyncio.gather(*[
+                self.scrape_filter_task(api_link, split_filter)
+                for split_filter in split_filters])
+
+    # The fetcher may be shared by several crawlers
+    async def run_async(self, fetcher: AsyncFetcher=None):
+        if fetcher == None:
+            async with AsyncFetcher() as fetcher:
+                return await self.run_async(fetcher)
+
+        self.fetcher = fetcher
+        if self.frontier != None:
+            pending = await run_blocking(self.frontier.get_pending)
+            if pending:
+                logging.info(f'Scraping {len(pending)} pending items.')
+                await self.scrape_links(pending)
+                await run_blocking(self.frontier.remove_pending, pending)
+
+        tasks = []
+        for api_link in self.category.get_api_links():
+            for item_filter in await run_blocking(
+                    self.plan_filters, api_link, self.item_filters):
+                tasks.append(self.scrape_filter_task(api_link, item_filter))
+        logging.info(f'Starting {len(tasks)} filter walks.')
+        await asyncio.gather(*tasks)
+        self.fetcher = None
+
+    def run(self) -> list:
+        return run_crawlers([self], self.parse_processes)[0]
+
+# Runs crawlers simultaneously sharing a single fetching pipeline (or a single
+# asyncio fetcher), returns the list of their results
+def run_crawlers(crawlers: list, parse_processes: int=None) -> list:
+    if all(isinstance(crawler, AsyncCrawler) for crawler in crawlers):
+        parsers = None
+        if parse_processes:
+            parsers = ProcessPoolExecutor(max_workers=parse_processes)
+
+        async def run_async():
+            async with AsyncFetcher() as fetcher:
+                await asyncio.gather(*[crawler.run_async(fetcher)
+                                       for crawler in crawlers])
+
+        for crawler in crawlers:
+            crawler.parsers = parsers
+        try:
+            asyncio.run(run_async())
+        finally:
+            for crawler in crawlers:
+                crawler.parsers = None
+            if parsers != None:
+                parsers.shutdown()
+
+        return [crawler.finish() for crawler in crawlers]
+
+    workers = min(len(crawlers), PLAN_WORKERS)
+    fetch_log = crawlers[0].fetch_log
+    with ScrapePipeline(workers=WORKERS * SUBDOMAIN_WORKERS * workers,
+                        parse_processes=parse_processes,
+                        fetch_log=fetch_log) as pipeline:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                return list(executor.map(
+                    lambda crawler: crawler.run(pipeline), crawlers))
+            except BaseException:
+                for crawler in crawlers:
+                    crawler.stop()
+                raise
+
+# Creates a crawler for the engine chosen by USE_ASYNC
+def create_crawler(items: list, store: ItemStore, seen: SeenIndex,
+                   frontier: CrawlFrontier=None, fetch_log: FetchLog=None,
+                   planner: FilterPlanner=None,
+                   category: Category=None) -> Crawler:
+    if USE_ASYNC:
+        parse_processes = PARSE_PROCESSES if USE_PARSE_PROCESSES else None
+        return AsyncCrawler(items, store, seen, frontier,
+                            parse_processes=parse_processes,
+                            fetch_log=fetch_log, planner=planner,
+                            category=category)
+
+    return Crawler(items, store, seen, frontier, fetch_log=fetch_log,
+                   planner=planner, category=category)
+
+# items parameter may contain previous scraping result,
+# each new item is appended to the store as soon as it is scraped.
+# If frontier is given, the crawl continues from the point it was stopped at.
+def scrape_items(items: list=[], store: ItemStore=None,
+                 seen: SeenIndex=None, frontier: CrawlFrontier=None,
+                 fetch_log: FetchLog=None, planner: FilterPlanner=None,
+                 category: Category=None) -> list:
+    own_seen = seen == None
+    if own_seen:
+        filename = SEEN_FILENAME
+        if category != None:
+            filename = category.seen_filename
+        seen = SeenIndex(get_item_urls(items), filename=filename,
+                         bloom_capacity=BLOOM_CAPACITY)
 
-# Saving prepared item data to a CSV file
-def save_item(item: dict, filename: str, first_item=False) -> bool:
     try:
-        with open(filename, 'w' if first_item else 'a',
-                  newline='', encoding='utf-8') as f:
+        return create_crawler(items, store, seen, frontier, fetch_log,
+                              planner, category).run()
+    finally:
+        if own_seen:
+            seen.close()
+
+# Re-fetches the item page with a conditional request, returns the new item
+# version if the item data has changed or None otherwise. The stored item
+# version is compared as well, since the log may hold a fingerprint of
+# another format.
+def refresh_item(url: str, fetch_log: FetchLog,
+                 category_caption: str=CATEGORY_CAPTION,
+                 stored_item: Item=None) -> Item:
+    response = get_response(url, cache=False,
+                            headers=fetch_log.get_conditional_headers(url))
+    if response == None:
+        return None
+    if response.status_code == requests.codes.not_modified:
+        fetch_log.touch(url)
+        return None
+
+    item = parse_item(url, response.text, category_caption)
+    if item == None:
+        return None
+    data = item.to_dict()
+    changed = (item != stored_item
+               and fetch_log.is_changed(url, get_fingerprint(data)))
+    fetch_log.record_response(url, response, data)
+    return item if changed else None
+
+# Refreshes stored items checked earlier than max_age seconds ago, their
+# changed versions are appended to the store. Items unknown to the fetch log
+# (stored before it was kept) are only registered as checked now, so they
+# are not re-fetched all at once. Returns the count of updated items.
+def refresh_items(store: ItemStore, fetch_log: FetchLog,
+                  max_age: float=RECRAWL_AGE,
+                  category_caption: str=CATEGORY_CAPTION) -> int:
+    unknown = []
+    stale = []
+    for item in store:
+        url = get_item_url(item)
+        if fetch_log.get(url) == None:
+            unknown.append((url, item.to_dict()))
+        elif fetch_log.is_stale(url, max_age):
+            stale.append((url, item))
+    if unknown:
+        logging.info(f'{fetch_log.seed(unknown)} items added to the fetch '
+                     'log.')
+    logging.info(f'Refreshing {len(stale)} items.')
+
+    updated = 0
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        for item in executor.map(
+                lambda entry: refresh_item(entry[0], fetch_log,
+                                           category_caption, entry[1]),
+                stale):
+            if item != None:
+                store.append(item)
+                updated += 1
+
+    logging.info(f'{updated} items changed.')
+    return updated
+
+# Saves items to a CSV file in a single pass through one buffered writer.
+# items may be any iterable which can be walked twice (e.g. a list or
+# ItemStore): the first pass collects dynamic social network columns.
+@METRICS.timed('export_seconds', format='csv')
+def save_items_csv(items, filename: str) -> bool:
+    columns = get_columns(get_all_social_nets(items))
+    try:
+        with open(filename, 'w', newline='', encoding='utf-8',
+                  buffering=CSV_BUFFER_SIZE) as f:
             writer = csv.writer(f, delimiter=CSV_DELIMITER)
-            if first_item:
-                writer.writerow(COLUMNS)
-            writer.writerow([item[key] for key in COLUMNS])
+            writer.writerow(columns)
+            writer.writerows([item.get(key, '') for key in columns]
+                             for item in items)
     except OSError:
         logging.error(f'Can\'t write to CSV file {filename}.')
         return False
@@ -397,18 +1437,95 @@ def save_item(item: dict, filename: str, first_item=False) -> bool:
 
     return True
 
-# Saves prepared items list to a CSV file
-def save_items_csv(items: list, filename: str) -> bool:
-    # Workaround for dynamic social columns
-    social_nets_fix(get_all_social_nets(items), items)
+# items may be any iterable (e.g. a list or ItemStore)
+def get_image_urls(items):
+    for item in items:
+        if item['Фото']:
+            yield from item['Фото'].split('; ')
+
+# Downloads photos of all the stored items, returns URL -> file name dict
+def download_images(store: ItemStore) -> dict:
+    return ImageDownloader().download_all(get_image_urls(store))
+
+# Exports all the stored items to a CSV file sorted by city and name
+def export_csv(store: ItemStore, filename: str) -> bool:
+    with sort_items(store) as items:
+        return save_items_csv(items, filename)
+
+# Returns the schema of the columnar export: COLUMNS with list columns for
+# LIST_SEPARATORS fields and a map column for social network links
+def get_arrow_schema() -> 'pyarrow.Schema':
+    fields = [(column, pyarrow.list_(pyarrow.string())
+               if column in LIST_SEPARATORS else pyarrow.string())
+              for column in COLUMNS]
+    fields.append((SOCIAL_NETS_KEY,
+                   pyarrow.map_(pyarrow.string(), pyarrow.string())))
+    return pyarrow.schema(fields)
+
+def get_arrow_table(items: list, schema: 'pyarrow.Schema') -> 'pyarrow.Table':
+    columns = []
+    for column in COLUMNS:
+        values = [item.get(column, '') for item in items]
+        separator = LIST_SEPARATORS.get(column)
+        if separator != None:
+            values = [value.split(separator) if value else []
+                      for value in values]
+        columns.append(values)
+    columns.append([list(item.get(SOCIAL_NETS_KEY, {}).items())
+                    for item in items])
+
+    return pyarrow.Table.from_arrays(
+        [pyarrow.array(values, type=field.type)
+         for values, field in zip(columns, schema)], schema=schema)
+
+# Yields lists of at most size items
+def get_batches(items, size: int):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Saves items to a compressed columnar file: Parquet or Arrow IPC (if the
+# file name ends with .arrow). Items are written in batches, so items may be
+# any iterable (e.g. ItemStore).
+@METRICS.timed('export_seconds', format='parquet')
+def save_items_parquet(items, filename: str) -> bool:
+    if pyarrow == None:
+        logging.error('pyarrow package is required for Parquet export.')
+        return False
 
-    for index, item in enumerate(items):
-        if not save_item(item, filename, first_item = (index == 0)):
-            return False
+    schema = get_arrow_schema()
+    try:
+        if filename.endswith('.arrow'):
+            writer = pyarrow.ipc.new_file(
+                filename, schema, options=pyarrow.ipc.IpcWriteOptions(
+                    compression=PARQUET_COMPRESSION))
+        else:
+            writer = pyarrow.parquet.ParquetWriter(
+                filename, schema, compression=PARQUET_COMPRESSION)
+        with writer:
+            for batch in get_batches(items, PARQUET_BATCH_SIZE):
+                writer.write_table(get_arrow_table(batch, schema))
+    except OSError:
+        logging.error(f"Can't write to the file {filename}.")
+        return False
+    except Exception as e:
+        logging.error('Scraped data saving fault. ' + str(e))
+        return False
 
     return True
 
+# Exports all the stored items to a columnar file sorted by city and name
+def export_parquet(store: ItemStore, filename: str) -> bool:
+    with sort_items(store) as items:
+        return save_items_parquet(items, filename)
+
 # Saves item list to a JSON file
+@METRICS.timed('export_seconds', format='json')
 def save_items_json(items: list, filename: str) -> bool:
     try:
         with open(filename, 'w', encoding='utf-8') as f:
@@ -429,7 +1546,19 @@ def load_items_json(filename: str) -> list:
 
     return items
 
-# System handler for correct CTRL-C processing
+# Loads items from the store, previous JSON results are imported on first run
+def load_items(store: ItemStore, json_filename: str=JSON_FILENAME) -> list:
+    items = store.load()
+    if not items and json_filename and os.path.exists(json_filename):
+        items = [Item.from_dict(item)
+                 for item in load_items_json(json_filename)]
+        logging.info(f'Importing {len(items)} items from {json_filename}.')
+        store.extend(items)
+
+    return items
+
+# System handler for correct CTRL-C processing.
+# Crawl progress is already saved, so the next run resumes from this point.
 def sigint_handler(signal_received, frame):
     logging.info('SIGINT or CTRL-C detected. Program execution halted.')
     sys.exit(0)
@@ -445,29 +1574,108 @@ def _fix_items():
 
 # For debug:
 def _json_to_csv():
-    items = load_items_json(JSON_FILENAME)
-    items_sort(items)
-    if save_items_csv(items, CSV_FILENAME):
-        print('Saving complete.')
+    with ItemStore(STORE_FILENAME, item_factory=Item.from_dict,
+                   key=get_item_url) as store:
+        load_items(store)
+        if export_csv(store, CSV_FILENAME):
+            print('Saving complete.')
+
+# Crawls the categories in a single process. HTTP connections, rate limits,
+# filter statistics and the fetch log are shared, each category has its own
+# store, frontier, seen URLs index and CSV file. Returns False on failure.
+def run_plan(categories: list) -> bool:
+    with ExitStack() as stack:
+        stores = [stack.enter_context(
+                      ItemStore(category.store_filename,
+                                item_factory=Item.from_dict,
+                                key=get_item_url))
+                  for category in categories]
+        frontiers = [stack.enter_context(
+                         CrawlFrontier(category.frontier_filename))
+                     for category in categories]
+        fetch_log = stack.enter_context(FetchLog(FETCH_LOG_FILENAME))
+        planner = None
+        if PLAN_FILTERS:
+            planner = stack.enter_context(FilterPlanner(PLANNER_FILENAME))
+
+        item_lists = [load_items(store, category.json_filename)
+                      for store, category in zip(stores, categories)]
+        seens = []
+        for items, category in zip(item_lists, categories):
+            seen = SeenIndex(get_item_urls(items),
+                             filename=category.seen_filename,
+                             bloom_capacity=BLOOM_CAPACITY)
+            stack.callback(seen.close)
+            seens.append(seen)
+
+        crawlers = [create_crawler(items, store, seen, frontier, fetch_log,
+                                   planner, category)
+                    for items, store, seen, frontier, category in zip(
+                        item_lists, stores, seens, frontiers, categories)]
+        parse_processes = PARSE_PROCESSES if USE_PARSE_PROCESSES else None
+        # Images are downloaded via the same session and Tor pool, so they
+        # are closed at the very end
+        try:
+            results = run_crawlers(crawlers, parse_processes)
+            if RECRAWL:
+                for store, category in zip(stores, categories):
+                    refresh_items(store, fetch_log,
+                                  category_caption=category.caption)
+            if None in results:
+                return False
+            logging.info('Scraping process complete. Now saving the '
+                         'results.')
+
+            # Items are streamed from the stores, the lists are not needed
+            # anymore
+            del item_lists, results, crawlers
+            for store, category in zip(stores, categories):
+                if not export_csv(store, category.csv_filename):
+                    return False
+                if EXPORT_PARQUET and not export_parquet(
+                        store, category.parquet_filename):
+                    return False
+            logging.info('Saving complete.')
+
+            if DOWNLOAD_IMAGES:
+                logging.info('Downloading images.')
+                for store in stores:
+                    files = download_images(store)
+                    logging.info(f'{len(files)} images downloaded.')
+        finally:
+            close_session()
+            close_cache()
+            stop_tor_pool()
+
+    return True
 
 # Script entry point
 def main():
     setup_logging()
     signal(SIGINT, sigint_handler)
 
-    logging.info('Starting scraping process.')
-    items = scrape_items(load_items_json(JSON_FILENAME))
-    if items == None:
+    categories = [get_default_category()]
+    if CRAWL_PLAN_FILENAME != None:
+        categories = load_crawl_plan(CRAWL_PLAN_FILENAME)
+        if not categories:
+            logging.error(FATAL_ERROR_STR)
+            return
+
+    if EXPORT_PARQUET and pyarrow == None:
+        logging.error('pyarrow package is required for Parquet export.')
         logging.error(FATAL_ERROR_STR)
         return
-    logging.info('Scraping process complete. Now saving the results.')
 
-    items_sort(items)
-    if not save_items_csv(items, CSV_FILENAME):
+    if USE_TOR_POOL and not start_tor_pool():
         logging.error(FATAL_ERROR_STR)
         return
-    logging.info('Saving complete.')
 
+    logging.info(f'Starting scraping process for {len(categories)} '
+                 'categories.')
+    # The summary is logged and the metrics file is updated periodically
+    with MetricsReporter():
+        if not run_plan(categories):
+            logging.error(FATAL_ERROR_STR)
 
 if __name__ == '__main__':
     # main()